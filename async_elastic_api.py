@@ -0,0 +1,502 @@
+import asyncio
+import threading
+import time
+from typing import AsyncIterator, Awaitable, Optional
+
+import httpx
+
+import elastic_api
+import metrics
+import resilience
+from elastic_api import (
+    ENDPOINT_TIMEOUTS,
+    PAGE_FETCH_CONCURRENCY,
+    PAGE_LIMIT,
+    POOL_SIZE,
+    REQUEST_TIMEOUT,
+    STALE_READ_ENDPOINTS,
+    get_auth_headers,
+    get_endpoint_name,
+    moltin_guard,
+)
+
+
+_client = None
+_loop = None
+_loop_lock = threading.Lock()
+
+
+async def mark_request_start(request: httpx.Request):
+    request.extensions["started_at"] = time.perf_counter()
+
+
+async def record_response(response: httpx.Response):
+    request = response.request
+    metrics.record_api_call(
+        service="moltin",
+        endpoint=get_endpoint_name(request.method, str(request.url)),
+        status="stale" if "X-Stale" in response.headers else str(response.status_code),
+        seconds=time.perf_counter() - request.extensions["started_at"],
+    )
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    # the async side of elastic_api.ResilientHTTPAdapter, sharing its
+    # breakers, rate limiter and last good responses
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    @staticmethod
+    def _get_stale_response(
+        request: httpx.Request, endpoint: str
+    ) -> Optional[httpx.Response]:
+        if not STALE_READ_ENDPOINTS.fullmatch(endpoint):
+            return None
+        stale_body = moltin_guard.get_stale(str(request.url))
+        metrics.record_cache_lookup("moltin_stale", hit=stale_body is not None)
+        if stale_body is None:
+            return None
+        return httpx.Response(
+            200,
+            content=stale_body,
+            headers={"Content-Type": "application/json", "X-Stale": "1"},
+            request=request,
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = get_endpoint_name(request.method, str(request.url))
+        if endpoint in ENDPOINT_TIMEOUTS:
+            connect_timeout, read_timeout = ENDPOINT_TIMEOUTS[endpoint]
+            request.extensions["timeout"] = httpx.Timeout(
+                read_timeout, connect=connect_timeout
+            ).as_dict()
+        try:
+            is_trial, delay = moltin_guard.admit(endpoint)
+        except resilience.ServiceUnavailableError:
+            stale_response = self._get_stale_response(request, endpoint)
+            if stale_response is None:
+                raise
+            return stale_response
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+
+            try:
+                response = await self.transport.handle_async_request(request)
+            except httpx.TransportError:
+                moltin_guard.record(endpoint, is_trial, status_code=None)
+                stale_response = self._get_stale_response(request, endpoint)
+                if stale_response is None:
+                    raise
+                return stale_response
+
+            is_failure = moltin_guard.record(
+                endpoint, is_trial, response.status_code, response.headers
+            )
+            if is_failure:
+                stale_response = self._get_stale_response(request, endpoint)
+                if stale_response is None:
+                    return response
+                await response.aclose()
+                return stale_response
+            if response.status_code == 200 and STALE_READ_ENDPOINTS.fullmatch(endpoint):
+                await response.aread()
+                moltin_guard.store_stale(str(request.url), response.content)
+
+            return response
+        finally:
+            moltin_guard.release(endpoint, is_trial)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        connect_timeout, read_timeout = REQUEST_TIMEOUT
+        _client = httpx.AsyncClient(
+            base_url=elastic_api.get_api_url(),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            transport=ResilientTransport(
+                httpx.AsyncHTTPTransport(
+                    limits=httpx.Limits(
+                        max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE
+                    )
+                )
+            ),
+            event_hooks={
+                "request": [mark_request_start],
+                "response": [record_response],
+            },
+        )
+    return _client
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+
+def run(coroutine: Awaitable):
+    # lets synchronous handlers await Moltin calls on the shared event loop
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result()
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get_credential_token(client_id: str, client_secret: str) -> dict:
+    data = {
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "grant_type": "client_credentials",
+    }
+
+    response = await get_client().post("/oauth/access_token", data=data)
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def get_page(credential_token: str, url: str, offset: int = 0) -> dict:
+    # keep the brackets unescaped like the synchronous client does
+    response = await get_client().get(
+        f"{url}?page[limit]={PAGE_LIMIT}&page[offset]={offset}",
+        headers=get_auth_headers(credential_token),
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def iterate_pages(
+    credential_token: str, url: str, concurrency: int = PAGE_FETCH_CONCURRENCY
+) -> AsyncIterator[dict]:
+    first_page = await get_page(credential_token=credential_token, url=url)
+    for item in first_page["data"]:
+        yield item
+
+    meta = first_page.get("meta", {})
+    total = meta.get("results", {}).get("total")
+    limit = meta.get("page", {}).get("limit", PAGE_LIMIT)
+
+    if total is None:
+        next_url = first_page.get("links", {}).get("next")
+        while next_url:
+            response = await get_client().get(
+                next_url, headers=get_auth_headers(credential_token)
+            )
+            response.raise_for_status()
+            page = response.json()
+            for item in page["data"]:
+                yield item
+            next_url = page.get("links", {}).get("next")
+        return
+
+    offsets = list(range(limit, total, limit))
+    for window_start in range(0, len(offsets), concurrency):
+        pages = await asyncio.gather(
+            *[
+                get_page(credential_token=credential_token, url=url, offset=offset)
+                for offset in offsets[window_start : window_start + concurrency]
+            ]
+        )
+        for page in pages:
+            for item in page["data"]:
+                yield item
+
+
+async def get_all_products(credential_token: str) -> dict:
+    return {
+        "data": [
+            product
+            async for product in iterate_pages(
+                credential_token=credential_token, url="/v2/products"
+            )
+        ]
+    }
+
+
+async def create_product(
+    credential_token: str, product_details: dict, sku: int
+) -> dict:
+    json_data = {
+        "data": {
+            "type": "product",
+            "name": product_details.get("name"),
+            "slug": str(product_details.get("id")),
+            "sku": str(sku),
+            "description": product_details.get("description"),
+            "manage_stock": False,
+            "price": [
+                {
+                    "amount": product_details.get("price"),
+                    "currency": "RUB",
+                    "includes_tax": True,
+                },
+            ],
+            "status": "live",
+            "commodity_type": "physical",
+        },
+    }
+
+    response = await get_client().post(
+        "/v2/products", headers=get_auth_headers(credential_token), json=json_data
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def create_pizza_image(credential_token: str, image_url: str) -> dict:
+    response = await get_client().post(
+        "/v2/files",
+        headers=get_auth_headers(credential_token),
+        files={"file_location": (None, image_url)},
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def create_pizza_image_relationship(
+    credential_token: str, product_id: str, image_id: str
+) -> dict:
+    json_data = {
+        "data": {
+            "type": "main_image",
+            "id": image_id,
+        },
+    }
+    response = await get_client().post(
+        f"/v2/products/{product_id}/relationships/main-image",
+        headers=get_auth_headers(credential_token),
+        json=json_data,
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def create_flow(
+    credential_token: str, name: str, slug: str, description: str
+) -> dict:
+    json_data = {
+        "data": {
+            "type": "flow",
+            "name": name,
+            "slug": slug,
+            "description": description,
+            "enabled": True,
+        },
+    }
+
+    response = await get_client().post(
+        "/v2/flows", headers=get_auth_headers(credential_token), json=json_data
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def create_field(
+    credential_token: str, name: str, slug: str, description: str, flow_id: str
+) -> dict:
+    json_data = {
+        "data": {
+            "type": "field",
+            "name": name,
+            "slug": slug,
+            "field_type": "string",
+            "description": description,
+            "required": True,
+            "enabled": True,
+            "relationships": {
+                "flow": {
+                    "data": {
+                        "type": "flow",
+                        "id": flow_id,
+                    },
+                },
+            },
+        },
+    }
+
+    response = await get_client().post(
+        "/v2/fields", headers=get_auth_headers(credential_token), json=json_data
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def create_pizzeria_entry(
+    credential_token: str,
+    pizzeria_slug: str,
+    address: str,
+    alias: str,
+    longitude: str,
+    latitude: str,
+) -> dict:
+    json_data = {
+        "data": {
+            "type": "entry",
+            "address": address,
+            "alias": alias,
+            "longitude": longitude,
+            "latitude": latitude,
+        }
+    }
+
+    response = await get_client().post(
+        f"/v2/flows/{pizzeria_slug}/entries",
+        headers=get_auth_headers(credential_token),
+        json=json_data,
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def add_product_to_cart(
+    credential_token: str, product_id: str, quantity: int, cart_id: str
+) -> dict:
+    json_data = {
+        "data": {
+            "id": product_id,
+            "type": "cart_item",
+            "quantity": quantity,
+        }
+    }
+    response = await get_client().post(
+        f"/v2/carts/{cart_id}/items",
+        headers=get_auth_headers(credential_token),
+        json=json_data,
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def delete_product_from_cart(
+    credential_token: str, cart_id: str, product_id: str
+) -> dict:
+    response = await get_client().delete(
+        f"/v2/carts/{cart_id}/items/{product_id}",
+        headers=get_auth_headers(credential_token),
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def get_cart(credential_token: str, cart_id: str) -> dict:
+    response = await get_client().get(
+        f"/v2/carts/{cart_id}", headers=get_auth_headers(credential_token)
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def get_cart_items(credential_token: str, cart_id: str) -> dict:
+    return {
+        "data": [
+            item
+            async for item in iterate_pages(
+                credential_token=credential_token, url=f"/v2/carts/{cart_id}/items"
+            )
+        ]
+    }
+
+
+async def get_product(credential_token: str, product_id: str) -> dict:
+    response = await get_client().get(
+        f"/v2/products/{product_id}", headers=get_auth_headers(credential_token)
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def get_file_href(credential_token: str, file_id: str) -> str:
+    response = await get_client().get(
+        f"/v2/files/{file_id}", headers=get_auth_headers(credential_token)
+    )
+    response.raise_for_status()
+    file_details = response.json()["data"]
+
+    return file_details["link"]["href"]
+
+
+async def create_customer(credential_token: str, user_id: str, email: str) -> dict:
+    payload = {
+        "data": {
+            "type": "customer",
+            "name": str(user_id),
+            "email": str(email),
+            "password": "mysecretpassword",
+        },
+    }
+
+    response = await get_client().post(
+        "/v2/customers", headers=get_auth_headers(credential_token), json=payload
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def get_customer(credential_token: str, customer_id: str) -> dict:
+    response = await get_client().get(
+        f"/v2/customers/{customer_id}", headers=get_auth_headers(credential_token)
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def get_all_entries(credential_token: str, slug: str) -> dict:
+    return {
+        "data": [
+            entry
+            async for entry in iterate_pages(
+                credential_token=credential_token, url=f"/v2/flows/{slug}/entries"
+            )
+        ]
+    }
+
+
+async def create_coordinates_entry(
+    credential_token: str,
+    coordinates_slug: str,
+    telegram_id: str,
+    longitude: str,
+    latitude: str,
+) -> dict:
+    json_data = {
+        "data": {
+            "type": "entry",
+            "telegram_id": telegram_id,
+            "longitude": longitude,
+            "latitude": latitude,
+        }
+    }
+
+    response = await get_client().post(
+        f"/v2/flows/{coordinates_slug}/entries",
+        headers=get_auth_headers(credential_token),
+        json=json_data,
+    )
+    response.raise_for_status()
+
+    return response.json()
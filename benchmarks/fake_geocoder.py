@@ -0,0 +1,66 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeGeocoder:
+    # stand-in for the Yandex geocoder, every address lands somewhere
+    # in Moscow and the same address always lands in the same place
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def geocode(self, address: str) -> dict:
+        address_hash = int(hashlib.sha1(address.encode()).hexdigest(), 16)
+        longitude = 37.3 + (address_hash % 6000) / 10000
+        latitude = 55.5 + (address_hash // 6000 % 4000) / 10000
+        return {
+            "response": {
+                "GeoObjectCollection": {
+                    "featureMember": [
+                        {"GeoObject": {"Point": {"pos": f"{longitude} {latitude}"}}}
+                    ]
+                }
+            }
+        }
+
+
+class FakeGeocoderRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "FakeGeocoderServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        geocoder = self.server.geocoder
+        if geocoder.latency:
+            time.sleep(geocoder.latency)
+
+        query = parse_qs(urlparse(self.path).query)
+        body = json.dumps(geocoder.geocode(query["geocode"][0])).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGeocoderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, geocoder: FakeGeocoder, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), FakeGeocoderRequestHandler)
+        self.geocoder = geocoder
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeGeocoderServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
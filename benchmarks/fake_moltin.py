@@ -0,0 +1,216 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeMoltin:
+    # in-memory stand-in for the parts of the Moltin API the bot uses
+    def __init__(
+        self,
+        products_count: int = 40,
+        pizzerias_count: int = 20,
+        description_size: int = 200,
+        latency: float = 0.0,
+        seed: int = 1,
+    ):
+        randomizer = random.Random(seed)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.files = {}
+        self.products = []
+        for number in range(products_count):
+            file_id = str(uuid.UUID(int=randomizer.getrandbits(128)))
+            self.files[file_id] = {
+                "id": file_id,
+                "type": "file",
+                "link": {"href": f"https://files.example.com/{file_id}.jpg"},
+            }
+            price = randomizer.randrange(300, 900, 10)
+            self.products.append(
+                {
+                    "id": str(uuid.UUID(int=randomizer.getrandbits(128))),
+                    "type": "product",
+                    "name": f"Пицца {number}",
+                    "slug": str(number),
+                    "sku": str(number),
+                    "description": "Тесто, сыр, томаты. " * (description_size // 20),
+                    "price": [
+                        {"amount": price, "currency": "RUB", "includes_tax": True}
+                    ],
+                    "meta": {
+                        "display_price": {
+                            "with_tax": {"amount": price, "formatted": f"{price} ₽"}
+                        }
+                    },
+                    "relationships": {
+                        "main_image": {"data": {"type": "main_image", "id": file_id}}
+                    },
+                }
+            )
+        self.flows = {
+            "pizzeria": [
+                {
+                    "id": str(uuid.UUID(int=randomizer.getrandbits(128))),
+                    "type": "entry",
+                    "address": f"Москва, улица {number}",
+                    "alias": f"Пиццерия {number}",
+                    "longitude": str(37.3 + randomizer.random() * 0.6),
+                    "latitude": str(55.5 + randomizer.random() * 0.4),
+                    "courier": str(1000 + number),
+                }
+                for number in range(pizzerias_count)
+            ],
+            "coordinates": [],
+        }
+        self.carts = {}
+
+    def get_product(self, product_id: str) -> dict:
+        return next(product for product in self.products if product["id"] == product_id)
+
+    def get_cart_items(self, cart_id: str) -> list[dict]:
+        return self.carts.setdefault(cart_id, [])
+
+    def add_to_cart(self, cart_id: str, product_id: str, quantity: int) -> list[dict]:
+        product = self.get_product(product_id)
+        price = product["price"][0]["amount"]
+        with self.lock:
+            cart_items = self.get_cart_items(cart_id)
+            for item in cart_items:
+                if item["product_id"] == product_id:
+                    item["quantity"] += quantity
+                    item["value"]["amount"] = item["quantity"] * price
+                    return cart_items
+            cart_items.append(
+                {
+                    "id": str(uuid.uuid4()),
+                    "type": "cart_item",
+                    "product_id": product_id,
+                    "name": product["name"],
+                    "description": product["description"],
+                    "quantity": quantity,
+                    "unit_price": {"amount": price},
+                    "value": {"amount": price * quantity},
+                }
+            )
+            return cart_items
+
+    def delete_from_cart(self, cart_id: str, item_id: str) -> list[dict]:
+        with self.lock:
+            cart_items = [
+                item for item in self.get_cart_items(cart_id) if item["id"] != item_id
+            ]
+            self.carts[cart_id] = cart_items
+            return cart_items
+
+
+def paginate(items: list, query: dict) -> dict:
+    limit = int(query.get("page[limit]", ["100"])[0])
+    offset = int(query.get("page[offset]", ["0"])[0])
+    return {
+        "data": items[offset : offset + limit],
+        "meta": {
+            "page": {
+                "limit": limit,
+                "offset": offset,
+                "current": offset // limit + 1,
+                "total": max(1, -(-len(items) // limit)),
+            },
+            "results": {"total": len(items)},
+        },
+    }
+
+
+class FakeMoltinRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "FakeMoltinServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> dict:
+        content_length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(content_length)
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body)
+        return {}
+
+    def _reply(self, status: int, response_details: dict):
+        body = json.dumps(response_details, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method: str):
+        moltin = self.server.moltin
+        if moltin.latency:
+            time.sleep(moltin.latency)
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path
+        request_details = self._read_json() if method == "POST" else {}
+
+        if path == "/oauth/access_token":
+            return self._reply(
+                200,
+                {"access_token": uuid.uuid4().hex, "expires": int(time.time()) + 3600},
+            )
+        if path == "/v2/products" and method == "GET":
+            return self._reply(200, paginate(moltin.products, query))
+        if match := re.fullmatch(r"/v2/products/([\w-]+)", path):
+            return self._reply(200, {"data": moltin.get_product(match[1])})
+        if match := re.fullmatch(r"/v2/files/([\w-]+)", path):
+            return self._reply(200, {"data": moltin.files[match[1]]})
+        if match := re.fullmatch(r"/v2/carts/([\w-]+)/items", path):
+            cart_id = match[1]
+            if method == "POST":
+                cart_item = request_details["data"]
+                moltin.add_to_cart(cart_id, cart_item["id"], cart_item["quantity"])
+            return self._reply(200, paginate(moltin.get_cart_items(cart_id), query))
+        if match := re.fullmatch(r"/v2/carts/([\w-]+)/items/([\w-]+)", path):
+            cart_items = moltin.delete_from_cart(match[1], match[2])
+            return self._reply(200, {"data": cart_items})
+        if match := re.fullmatch(r"/v2/flows/([\w-]+)/entries", path):
+            entries = moltin.flows.setdefault(match[1], [])
+            if method == "POST":
+                entry = {"id": str(uuid.uuid4()), **request_details["data"]}
+                with moltin.lock:
+                    entries.append(entry)
+                return self._reply(201, {"data": entry})
+            return self._reply(200, paginate(entries, query))
+
+        self._reply(404, {"errors": [{"title": "Not Found", "detail": path}]})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+
+class FakeMoltinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, moltin: FakeMoltin, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), FakeMoltinRequestHandler)
+        self.moltin = moltin
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeMoltinServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
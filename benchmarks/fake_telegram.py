@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from typing import Callable, Optional
+
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Pizza time",
+    "username": "pizza_time_bot",
+}
+MESSAGE_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "sendLocation",
+    "sendInvoice",
+    "editMessageText",
+}
+
+
+class FakeTelegram:
+    # in-memory stand-in for the Bot API methods the bot calls, every call
+    # is passed to the listener so a load generator can wait for replies
+    def __init__(
+        self,
+        latency: float = 0.0,
+        listener: Optional[Callable[[str, dict], None]] = None,
+    ):
+        self.latency = latency
+        self.listener = listener
+        self.webhook_details = {}
+        self.webhook_set = threading.Event()
+        self._message_ids = count(1)
+
+    def call(self, method: str, request_details: dict) -> object:
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self.webhook_details = request_details
+            self.webhook_set.set()
+            return True
+        if method in MESSAGE_METHODS:
+            message = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "from": BOT_USER,
+                "chat": {"id": int(request_details["chat_id"]), "type": "private"},
+            }
+            if method == "sendPhoto":
+                message["photo"] = [
+                    {
+                        "file_id": f"photo-{message['message_id']}",
+                        "file_unique_id": f"photo-{message['message_id']}",
+                        "width": 1280,
+                        "height": 1280,
+                    }
+                ]
+            return message
+        return True
+
+
+class FakeTelegramRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "FakeTelegramServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, response_details: dict):
+        body = json.dumps(response_details, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        telegram = self.server.telegram
+        if telegram.latency:
+            time.sleep(telegram.latency)
+
+        # the path is /bot<token>/<method>
+        method = self.path.rsplit("/", 1)[-1]
+        content_length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(content_length)
+        request_details = json.loads(body) if body else {}
+
+        result = telegram.call(method, request_details)
+        self._reply(200, {"ok": True, "result": result})
+        if telegram.listener:
+            telegram.listener(method, request_details)
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, telegram: FakeTelegram, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), FakeTelegramRequestHandler)
+        self.telegram = telegram
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeTelegramServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -0,0 +1,506 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from itertools import count
+from typing import Optional
+from urllib.parse import urlparse
+
+import httpx
+
+from benchmarks.fake_geocoder import FakeGeocoder, FakeGeocoderServer
+from benchmarks.fake_telegram import FakeTelegram, FakeTelegramServer
+from benchmarks.run_benchmarks import start_fake_moltin
+
+
+TELEGRAM_TOKEN = "123456:load-test"
+WEBHOOK_SECRET = "load-test"
+WEBHOOK_CONNECTIONS = 40  # Telegram's default max_connections for a webhook
+BOT_START_TIMEOUT = 60  # seconds
+REPLY_TIMEOUT = 30  # seconds
+STEPS = (
+    "start",
+    "page",
+    "description",
+    "add_to_cart",
+    "cart",
+    "checkout",
+    "delivery",
+    "payment",
+)
+
+update_ids = count(1)
+message_ids = count(1)
+
+
+def get_free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def get_product_ids(request_details: dict) -> list[str]:
+    keyboard = json.loads(request_details["reply_markup"])["inline_keyboard"]
+    callbacks = [button.get("callback_data", "") for row in keyboard for button in row]
+    return [
+        callback
+        for callback in callbacks
+        if callback and callback != "cart" and not callback.startswith("page")
+    ]
+
+
+def get_percentile(timings: list[float], percentile: int) -> float:
+    if len(timings) < 2:
+        return timings[0] * 1000 if timings else 0.0
+    return statistics.quantiles(timings, n=100)[percentile - 1] * 1000
+
+
+class LoadStats:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.rejected = 0
+        self.journeys = 0
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+
+    def record(self, step: str, seconds: float):
+        self.timings[step].append(seconds)
+
+    def record_error(self, step: str, reason: str):
+        self.errors[step][reason] += 1
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+
+    def get_summary(self) -> dict:
+        elapsed = self.finished_at - self.started_at
+        steps = sum(len(timings) for timings in self.timings.values())
+        errors = sum(sum(reasons.values()) for reasons in self.errors.values())
+        all_timings = [
+            seconds for timings in self.timings.values() for seconds in timings
+        ]
+        return {
+            "elapsed": elapsed,
+            "steps": steps,
+            "journeys": self.journeys,
+            "steps_per_second": steps / elapsed,
+            "journeys_per_second": self.journeys / elapsed,
+            "error_rate": errors / (steps + errors) if steps + errors else 0.0,
+            "rejected": self.rejected,
+            "p95_ms": get_percentile(all_timings, 95),
+            "states": {
+                step: {
+                    "count": len(self.timings[step]),
+                    "errors": dict(self.errors[step]),
+                    "p50_ms": get_percentile(self.timings[step], 50),
+                    "p95_ms": get_percentile(self.timings[step], 95),
+                    "p99_ms": get_percentile(self.timings[step], 99),
+                }
+                for step in STEPS
+            },
+        }
+
+
+class ReplyRouter:
+    # the fake Telegram calls in from its server threads, a reply is handed
+    # to the virtual user waiting for that method in that chat
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.waiting = {}
+
+    def expect(self, chat_id: int, method: str) -> asyncio.Future:
+        reply = self.loop.create_future()
+        self.waiting[chat_id] = (method, reply)
+        return reply
+
+    def forget(self, chat_id: int):
+        self.waiting.pop(chat_id, None)
+
+    @staticmethod
+    def _resolve(reply: asyncio.Future, request_details: dict):
+        if not reply.done():
+            reply.set_result(request_details)
+
+    def __call__(self, method: str, request_details: dict):
+        chat_id = request_details.get("chat_id")
+        if chat_id is None and "callback_query_id" in request_details:
+            chat_id, _ = request_details["callback_query_id"].split(":")
+        if chat_id is None:
+            return
+
+        expected_method, reply = self.waiting.get(int(chat_id), (None, None))
+        if method == expected_method:
+            self.loop.call_soon_threadsafe(self._resolve, reply, request_details)
+
+
+class VirtualUser:
+    # walks the conversation from /start to the invoice the way a customer
+    # taps through it, timing every step until the bot's reply arrives
+    def __init__(
+        self,
+        user_id: int,
+        client: httpx.AsyncClient,
+        router: ReplyRouter,
+        webhook_url: str,
+        stats: LoadStats,
+        randomizer: random.Random,
+        addresses: int,
+        text_address_share: float,
+        think_time: float,
+    ):
+        self.user_id = user_id
+        self.client = client
+        self.router = router
+        self.webhook_url = webhook_url
+        self.stats = stats
+        self.randomizer = randomizer
+        self.addresses = addresses
+        self.text_address_share = text_address_share
+        self.think_time = think_time
+        self.user = {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"Customer {user_id}",
+        }
+
+    def _message(self, **fields) -> dict:
+        return {
+            "message": {
+                "message_id": next(message_ids),
+                "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private"},
+                "from": self.user,
+                **fields,
+            }
+        }
+
+    def _callback_query(self, data: str) -> dict:
+        return {
+            "callback_query": {
+                "id": f"{self.user_id}:{next(update_ids)}",
+                "from": self.user,
+                "chat_instance": str(self.user_id),
+                "data": data,
+                "message": self._message()["message"],
+            }
+        }
+
+    def _address(self) -> dict:
+        if self.randomizer.random() < self.text_address_share:
+            house = self.randomizer.randrange(self.addresses)
+            return self._message(text=f"Москва, ул. Тестовая, д. {house}")
+
+        return self._message(
+            location={
+                "longitude": 37.3 + self.randomizer.random() * 0.6,
+                "latitude": 55.5 + self.randomizer.random() * 0.4,
+            }
+        )
+
+    async def _post(self, update_details: dict) -> httpx.Response:
+        while True:
+            response = await self.client.post(
+                self.webhook_url,
+                json=update_details,
+                headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET},
+            )
+            if response.status_code != 503:
+                return response
+            # Telegram keeps redelivering while the bot is saturated
+            self.stats.rejected += 1
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+
+    async def _step(
+        self, step: str, update_details: dict, method: str
+    ) -> Optional[dict]:
+        if self.think_time:
+            await asyncio.sleep(self.randomizer.uniform(0, self.think_time * 2))
+
+        update_details["update_id"] = next(update_ids)
+        reply = self.router.expect(self.user_id, method)
+        started_at = time.perf_counter()
+        try:
+            response = await self._post(update_details)
+            if response.status_code != 200:
+                self.stats.record_error(step, f"HTTP {response.status_code}")
+                return None
+            request_details = await asyncio.wait_for(reply, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.record_error(step, "timeout")
+            return None
+        except httpx.HTTPError as error:
+            self.stats.record_error(step, type(error).__name__)
+            return None
+        finally:
+            self.router.forget(self.user_id)
+
+        self.stats.record(step, time.perf_counter() - started_at)
+        return request_details
+
+    async def walk(self) -> bool:
+        start_command = self._message(
+            text="/start",
+            entities=[{"type": "bot_command", "offset": 0, "length": 6}],
+        )
+        if not await self._step("start", start_command, "sendMessage"):
+            return False
+        menu = await self._step("page", self._callback_query("page 2"), "sendMessage")
+        if not menu:
+            return False
+
+        product_id = self.randomizer.choice(get_product_ids(menu))
+        steps = (
+            ("description", self._callback_query(product_id), "sendPhoto"),
+            ("add_to_cart", self._callback_query("1"), "answerCallbackQuery"),
+            ("cart", self._callback_query("cart"), "sendMessage"),
+            ("checkout", self._callback_query("checkout"), "sendMessage"),
+            ("delivery", self._address(), "sendMessage"),
+            ("payment", self._callback_query("delivery"), "sendInvoice"),
+        )
+        for step, update_details, method in steps:
+            if not await self._step(step, update_details, method):
+                return False
+
+        return True
+
+
+async def run_stage(
+    users: int,
+    duration: float,
+    ramp_up: float,
+    webhook_url: str,
+    router: ReplyRouter,
+    user_ids: count,
+    options: dict,
+    seed: int,
+    webhook_connections: int,
+) -> LoadStats:
+    stats = LoadStats()
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=webhook_connections)
+
+    async with httpx.AsyncClient(limits=limits, timeout=REPLY_TIMEOUT) as client:
+
+        async def keep_walking(index: int):
+            randomizer = random.Random(seed + index)
+            await asyncio.sleep(ramp_up * index / users)
+            # a finished customer is replaced by a new one, a conversation
+            # left at the invoice can't be started again
+            while time.monotonic() < deadline:
+                user = VirtualUser(
+                    next(user_ids),
+                    client=client,
+                    router=router,
+                    webhook_url=webhook_url,
+                    stats=stats,
+                    randomizer=randomizer,
+                    **options,
+                )
+                if await user.walk():
+                    stats.journeys += 1
+
+        await asyncio.gather(*(keep_walking(index) for index in range(users)))
+
+    stats.finish()
+    return stats
+
+
+def start_bot(
+    args: argparse.Namespace,
+    telegram_url: str,
+    moltin_url: str,
+    geocoder_url: str,
+    webhook_port: int,
+) -> subprocess.Popen:
+    redis_url = urlparse(args.redis_url)
+    bot_environment = {
+        **os.environ,
+        "TELEGRAM_TOKEN": TELEGRAM_TOKEN,
+        "TELEGRAM_API_URL": f"{telegram_url}/bot",
+        "TELEGRAM_MODE": "sharded" if args.shards else "webhook",
+        "SHARD_PROCESSES": str(args.shards),
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(webhook_port),
+        "WEBHOOK_URL": f"http://127.0.0.1:{webhook_port}/telegram",
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "BOT_WORKERS": str(args.bot_workers),
+        "METRICS_PORT": "0",
+        "ELASTIC_API_URL": moltin_url,
+        "ELASTIC_CLIENT_ID": "load-test",
+        "ELASTIC_CLIENT_SECRET": "load-test",
+        "GEOCODER_URL": geocoder_url,
+        "YANDEX_GEOCODE_TOKEN": "load-test",
+        "SBER_PAYMENT_TOKEN": "load-test",
+        "REDIS_HOST": redis_url.hostname or "localhost",
+        "REDIS_PORT": str(redis_url.port or 6379),
+        "REDIS_NAME": redis_url.path.lstrip("/") or "0",
+        "REDIS_PASSWORD": redis_url.password or "",
+    }
+    with open(args.bot_log, "w") as bot_log:
+        return subprocess.Popen(
+            [sys.executable, "telegram_bot.py"],
+            env=bot_environment,
+            stdout=bot_log,
+            stderr=subprocess.STDOUT,
+        )
+
+
+def print_stage(users: int, summary: dict):
+    print(
+        f"\n{users} users: {summary['steps']} steps and {summary['journeys']} "
+        f"journeys in {summary['elapsed']:.1f}s, "
+        f"{summary['steps_per_second']:.1f} steps/s, "
+        f"errors {summary['error_rate']:.2%}, rejected {summary['rejected']}"
+    )
+    print(
+        f"{'state':<14}{'count':>8}{'errors':>8}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    )
+    for step, state in summary["states"].items():
+        print(
+            f"{step:<14}{state['count']:>8}{sum(state['errors'].values()):>8}"
+            f"{state['p50_ms']:>10.1f}{state['p95_ms']:>10.1f}{state['p99_ms']:>10.1f}"
+        )
+
+
+def print_saturation(summaries: dict):
+    print(f"\n{'users':>8}{'steps/s':>10}{'journeys/s':>12}{'p95 ms':>10}{'errors':>9}")
+    for users, summary in summaries.items():
+        print(
+            f"{users:>8}{summary['steps_per_second']:>10.1f}"
+            f"{summary['journeys_per_second']:>12.2f}"
+            f"{summary['p95_ms']:>10.1f}{summary['error_rate']:>9.2%}"
+        )
+
+
+async def run_load_test(args: argparse.Namespace) -> dict:
+    loop = asyncio.get_running_loop()
+    router = ReplyRouter(loop)
+    telegram = FakeTelegram(latency=args.telegram_latency, listener=router)
+    telegram_server = FakeTelegramServer(telegram).start()
+    geocoder_server = FakeGeocoderServer(
+        FakeGeocoder(latency=args.geocoder_latency)
+    ).start()
+    _, moltin_url = start_fake_moltin(
+        {
+            "products_count": args.products,
+            "pizzerias_count": args.pizzerias,
+            "latency": args.moltin_latency,
+        }
+    )
+
+    webhook_port = get_free_port()
+    bot_process = start_bot(
+        args,
+        telegram_url=telegram_server.url,
+        moltin_url=moltin_url,
+        geocoder_url=geocoder_server.url,
+        webhook_port=webhook_port,
+    )
+    try:
+        is_started = await loop.run_in_executor(
+            None, telegram.webhook_set.wait, BOT_START_TIMEOUT
+        )
+        if not is_started or bot_process.poll() is not None:
+            sys.exit(f"The bot didn't start, see {args.bot_log}")
+
+        webhook_url = f"http://127.0.0.1:{webhook_port}/telegram"
+        # ids are random per run, conversations persisted in Redis
+        # by earlier runs must not get in the way
+        user_ids = count(random.randrange(10**9, 10**12, 10**6))
+        options = {
+            "addresses": args.addresses,
+            "text_address_share": args.text_address_share,
+            "think_time": args.think_time,
+        }
+
+        # one customer walks through first, so caches are warm and
+        # the first stage doesn't measure the bot's start
+        async with httpx.AsyncClient(timeout=REPLY_TIMEOUT) as client:
+            first_customer = VirtualUser(
+                next(user_ids),
+                client=client,
+                router=router,
+                webhook_url=webhook_url,
+                stats=LoadStats(),
+                randomizer=random.Random(args.seed),
+                **options,
+            )
+            if not await first_customer.walk():
+                sys.exit(f"The first customer got stuck, see {args.bot_log}")
+
+        summaries = {}
+        for users in args.users:
+            stats = await run_stage(
+                users,
+                duration=args.duration,
+                ramp_up=args.ramp_up,
+                webhook_url=webhook_url,
+                router=router,
+                user_ids=user_ids,
+                options=options,
+                seed=args.seed,
+                webhook_connections=args.webhook_connections,
+            )
+            summaries[users] = stats.get_summary()
+            print_stage(users, summaries[users])
+    finally:
+        bot_process.terminate()
+        try:
+            bot_process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            bot_process.kill()
+
+    return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Walk virtual customers through the bot against fake "
+        "Telegram, Moltin and Yandex servers"
+    )
+    parser.add_argument(
+        "--users",
+        type=lambda users: [int(stage) for stage in users.split(",")],
+        default=[50, 200, 1000],
+        help="concurrent customers per stage, comma separated",
+    )
+    parser.add_argument("--duration", type=float, default=30, help="seconds per stage")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds")
+    parser.add_argument("--think-time", type=float, default=0.5, help="seconds")
+    parser.add_argument("--webhook-connections", type=int, default=WEBHOOK_CONNECTIONS)
+    parser.add_argument("--bot-workers", type=int, default=8)
+    parser.add_argument(
+        "--shards", type=int, default=0, help="run the bot as that many processes"
+    )
+    parser.add_argument("--products", type=int, default=40)
+    parser.add_argument("--pizzerias", type=int, default=20)
+    parser.add_argument("--addresses", type=int, default=500)
+    parser.add_argument("--text-address-share", type=float, default=0.5)
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--moltin-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--geocoder-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--bot-log", default="load_test_bot.log")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    summaries = asyncio.run(run_load_test(args))
+    print_saturation(summaries)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(summaries, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+import redis
+
+import async_elastic_api
+import elastic_api
+import geocode
+import keyboards
+from benchmarks.fake_moltin import FakeMoltin, FakeMoltinServer
+from cart_mirror import CartMirror
+from catalog import CatalogCache
+from product_cache import ProductCache
+from write_behind import CoordinatesWriter
+
+
+BASELINE_PATH = "benchmarks/baseline.json"
+ITERATIONS = 200
+ALLOCATION_ITERATIONS = 20
+TOLERANCE = 0.2
+MIN_REGRESSION_MS = 0.5  # timer noise on sub-millisecond cases
+RECHECKS = 2
+USER_ID = "100500"
+USER_COORDINATES = ("37.62", "55.75")
+
+
+def serve_fake_moltin(options: dict, addresses: multiprocessing.Queue):
+    server = FakeMoltinServer(FakeMoltin(**options))
+    addresses.put(server.url)
+    server.serve_forever()
+
+
+def start_fake_moltin(options: dict) -> tuple[multiprocessing.Process, str]:
+    # a separate process keeps the server out of the measured timings
+    # and allocations
+    addresses = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=serve_fake_moltin, args=(options, addresses), daemon=True
+    )
+    process.start()
+
+    return process, addresses.get(timeout=10)
+
+
+class Case:
+    def __init__(
+        self, name: str, function: Callable, setup: Optional[Callable] = None
+    ):
+        self.name = name
+        self.function = function
+        self.setup = setup or (lambda: None)
+
+    def measure(self, iterations: int, allocation_iterations: int) -> dict:
+        self.setup()
+        self.function()  # warm up connections and caches
+
+        timings = []
+        for _ in range(iterations):
+            self.setup()
+            started_at = time.perf_counter()
+            self.function()
+            timings.append(time.perf_counter() - started_at)
+
+        peaks, blocks = [], []
+        tracemalloc.start()
+        for _ in range(allocation_iterations):
+            self.setup()
+            tracemalloc.reset_peak()
+            blocks_before = len(tracemalloc.take_snapshot().traces)
+            self.function()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            blocks.append(len(tracemalloc.take_snapshot().traces) - blocks_before)
+        tracemalloc.stop()
+
+        percentiles = statistics.quantiles(timings, n=100)
+        return {
+            "p50_ms": percentiles[49] * 1000,
+            "p95_ms": percentiles[94] * 1000,
+            "p99_ms": percentiles[98] * 1000,
+            "peak_kib": statistics.median(peaks) / 1024,
+            "retained_blocks": statistics.median(blocks),
+        }
+
+
+def get_cases(redis_connection: redis.Redis, elastic_token: str) -> list[Case]:
+    catalog = CatalogCache(page_renderer=keyboards.get_menu_page_markup)
+    product_cache = ProductCache(redis_connection)
+    cart_mirror = CartMirror(redis_connection)
+    pizzeria_index = geocode.PizzeriaIndex()
+    # nothing drains the queue during the run, enqueueing is what is measured
+    coordinates_writer = CoordinatesWriter(
+        redis_connection=redis_connection,
+        get_elastic_token=lambda: elastic_token,
+        queue_key="benchmark:coordinates",
+    )
+
+    product = elastic_api.get_all_products(credential_token=elastic_token)["data"][0]
+    file_id = product["relationships"]["main_image"]["data"]["id"]
+    cart_mirror.add_product(
+        elastic_token=elastic_token,
+        product_id=product["id"],
+        quantity=1,
+        cart_id=USER_ID,
+    )
+
+    def forget_product():
+        product_cache.invalidate_product(product["id"])
+        product_cache.invalidate_file_href(file_id)
+        redis_connection.delete(f"cart:{USER_ID}")
+
+    def forget_cart():
+        redis_connection.delete(f"cart:{USER_ID}")
+
+    def get_menu_markup(catalog=catalog):
+        keyboards.get_menu_markup(
+            catalog=catalog,
+            elastic_token=elastic_token,
+            user_first_name="Benchmark",
+            button_pressed="page 2",
+        )
+
+    def get_description_markup():
+        keyboards.get_description_markup(
+            product_cache=product_cache,
+            cart_mirror=cart_mirror,
+            elastic_token=elastic_token,
+            product_id=product["id"],
+            user_id=USER_ID,
+        )
+
+    def get_cart_markup():
+        keyboards.get_cart_markup(
+            cart_mirror=cart_mirror, elastic_token=elastic_token, cart_id=USER_ID
+        )
+
+    def get_delivery_markup():
+        keyboards.get_delivery_markup(
+            pizzeria_index=pizzeria_index,
+            coordinates_writer=coordinates_writer,
+            elastic_token=elastic_token,
+            user_coordinates=USER_COORDINATES,
+            user_id=USER_ID,
+        )
+
+    return [
+        Case(
+            "elastic_api.get_all_products",
+            lambda: elastic_api.get_all_products(credential_token=elastic_token),
+        ),
+        Case(
+            "elastic_api.get_cart_items",
+            lambda: elastic_api.get_cart_items(
+                credential_token=elastic_token, cart_id=USER_ID
+            ),
+        ),
+        Case("keyboards.get_menu_markup", get_menu_markup),
+        Case(
+            "keyboards.get_menu_markup[cold]",
+            lambda: get_menu_markup(
+                catalog=CatalogCache(page_renderer=keyboards.get_menu_page_markup)
+            ),
+        ),
+        Case("keyboards.get_description_markup", get_description_markup),
+        Case(
+            "keyboards.get_description_markup[cold]",
+            get_description_markup,
+            setup=forget_product,
+        ),
+        Case("keyboards.get_cart_markup", get_cart_markup),
+        Case("keyboards.get_cart_markup[cold]", get_cart_markup, setup=forget_cart),
+        Case("keyboards.get_delivery_markup", get_delivery_markup),
+    ]
+
+
+def compare_with_baseline(
+    results: dict, baseline: dict, tolerance: float
+) -> dict[str, list[str]]:
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            limit = max(
+                baseline[name][metric] * (1 + tolerance),
+                baseline[name][metric] + MIN_REGRESSION_MS,
+            )
+            if result[metric] > limit:
+                regressions.setdefault(name, []).append(
+                    f"{name} {metric}: {result[metric]:.3f} > {limit:.3f} "
+                    f"(baseline {baseline[name][metric]:.3f})"
+                )
+
+    return regressions
+
+
+def print_results(results: dict):
+    print(
+        f"{'case':<42}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'peak KiB':>10}{'blocks':>8}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<42}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}"
+            f"{result['p99_ms']:>10.3f}{result['peak_kib']:>10.1f}"
+            f"{result['retained_blocks']:>8.0f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark keyboards and elastic_api against a fake Moltin"
+    )
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument(
+        "--allocation-iterations", type=int, default=ALLOCATION_ITERATIONS
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--products", type=int, default=40)
+    parser.add_argument("--pizzerias", type=int, default=20)
+    parser.add_argument("--description-size", type=int, default=200)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    parameters = {
+        "products_count": args.products,
+        "pizzerias_count": args.pizzerias,
+        "description_size": args.description_size,
+        "latency": args.latency,
+    }
+    _, moltin_url = start_fake_moltin(parameters)
+    os.environ["ELASTIC_API_URL"] = moltin_url
+    redis_connection = redis.Redis.from_url(args.redis_url)
+
+    elastic_token = elastic_api.get_credential_token("benchmark", "benchmark")
+    cases = get_cases(redis_connection, elastic_token["access_token"])
+    results = {
+        case.name: case.measure(args.iterations, args.allocation_iterations)
+        for case in cases
+    }
+
+    if args.save_baseline:
+        # the slowest of a few runs, so the usual jitter of the machine
+        # doesn't show up as a regression later
+        for _ in range(RECHECKS):
+            for case in cases:
+                remeasured = case.measure(args.iterations, args.allocation_iterations)
+                results[case.name] = {
+                    metric: max(value, remeasured[metric])
+                    for metric, value in results[case.name].items()
+                }
+        print_results(results)
+        with open(args.baseline, "w") as file:
+            json.dump({"parameters": parameters, "results": results}, file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        async_elastic_api.run(async_elastic_api.close())
+        return
+
+    print_results(results)
+    try:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        sys.exit(
+            f"No baseline at {args.baseline}, run with --save-baseline on the "
+            "reference tree first"
+        )
+    # latencies measured against another catalog or fake latency aren't comparable
+    if baseline["parameters"] != parameters:
+        sys.exit(
+            f"The baseline was measured with {baseline['parameters']}, "
+            "run with the same options or save a new baseline"
+        )
+
+    regressions = compare_with_baseline(results, baseline["results"], args.tolerance)
+    cases_by_name = {case.name: case for case in cases}
+    for _ in range(RECHECKS):
+        if not regressions:
+            break
+        # a case has to stay slow on every rerun to count, one noisy run
+        # of a shared machine doesn't
+        for name in regressions:
+            remeasured = cases_by_name[name].measure(
+                args.iterations, args.allocation_iterations
+            )
+            results[name] = {
+                metric: min(value, remeasured[metric])
+                for metric, value in results[name].items()
+            }
+        regressions = compare_with_baseline(
+            results, baseline["results"], args.tolerance
+        )
+    async_elastic_api.run(async_elastic_api.close())
+
+    for case_regressions in regressions.values():
+        for regression in case_regressions:
+            print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import json
+from typing import Optional
+
+import redis
+
+import elastic_api
+import metrics
+
+
+CART_MIRROR_VERSION = 1
+CART_MIRROR_TTL = 7 * 24 * 60 * 60  # seconds
+
+
+class CartMirror:
+    # Moltin answers add and delete calls with the whole cart, so the mirror
+    # is written from those responses and read instead of fetching the cart
+    def __init__(self, redis_connection: redis.Redis, ttl: int = CART_MIRROR_TTL):
+        self.redis = redis_connection
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(cart_id: str) -> str:
+        return f"cart:{cart_id}"
+
+    def store(self, cart_id: str, cart_items: dict):
+        mirror = {"version": CART_MIRROR_VERSION, "data": cart_items["data"]}
+        self.redis.set(
+            self._key(cart_id), json.dumps(mirror, ensure_ascii=False), ex=self.ttl
+        )
+
+    def get_cached_cart_items(self, cart_id: str) -> Optional[dict]:
+        raw_mirror = self.redis.get(self._key(cart_id))
+        mirror = json.loads(raw_mirror) if raw_mirror else {}
+        is_valid = mirror.get("version") == CART_MIRROR_VERSION
+        metrics.record_cache_lookup("cart", hit=is_valid)
+        if not is_valid:
+            return None
+
+        return {"data": mirror["data"]}
+
+    def reconcile(self, elastic_token: str, cart_id: str) -> dict:
+        cart_items = elastic_api.get_cart_items(
+            credential_token=elastic_token, cart_id=cart_id
+        )
+        self.store(cart_id, cart_items)
+
+        return cart_items
+
+    def get_cart_items(self, elastic_token: str, cart_id: str) -> dict:
+        cart_items = self.get_cached_cart_items(cart_id)
+        if cart_items is None:
+            cart_items = self.reconcile(elastic_token=elastic_token, cart_id=cart_id)
+
+        return cart_items
+
+    def add_product(
+        self, elastic_token: str, product_id: str, quantity: int, cart_id: str
+    ) -> dict:
+        cart_items = elastic_api.add_product_to_cart(
+            credential_token=elastic_token,
+            product_id=product_id,
+            quantity=quantity,
+            cart_id=cart_id,
+        )
+        self.store(cart_id, cart_items)
+
+        return cart_items
+
+    def delete_product(self, elastic_token: str, cart_id: str, product_id: str) -> dict:
+        cart_items = elastic_api.delete_product_from_cart(
+            credential_token=elastic_token, cart_id=cart_id, product_id=product_id
+        )
+        self.store(cart_id, cart_items)
+
+        return cart_items
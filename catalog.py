@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+from more_itertools import chunked
+
+import elastic_api
+import metrics
+
+
+logger = logging.getLogger(__file__)
+
+CATALOG_TTL = 300  # seconds
+PRODUCTS_ON_MENU_PAGE = 8
+
+
+class CatalogCache:
+    # page_renderer(page_products, page_number, total_pages) prerenders every
+    # page once per catalog version, so all users share the same markup
+    def __init__(
+        self,
+        page_renderer: Callable[[list[dict], int, int], object],
+        ttl: int = CATALOG_TTL,
+        page_size: int = PRODUCTS_ON_MENU_PAGE,
+    ):
+        self.ttl = ttl
+        self.page_size = page_size
+        self.page_renderer = page_renderer
+        self.version = 0
+        self.products = []
+        self.pages = []
+        self.rendered_pages = []
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self.loaded_at >= self.ttl
+
+    def invalidate(self):
+        self.loaded_at = 0.0
+
+    def load(self, products: list[dict]):
+        pages = [list(chunk) for chunk in chunked(products, self.page_size)]
+        rendered_pages = [
+            self.page_renderer(page_products, page_number, len(pages))
+            for page_number, page_products in enumerate(pages, start=1)
+        ]
+        with self._lock:
+            self.products = products
+            self.pages = pages
+            self.rendered_pages = rendered_pages
+            self.version += 1
+            self.loaded_at = time.monotonic()
+
+    def refresh(self, elastic_token: str):
+        products = elastic_api.get_all_products(credential_token=elastic_token)
+        self.load(products["data"])
+        logger.info(f"Catalog refreshed, version {self.version}")
+
+    def _refresh_in_background(self, elastic_token: str):
+        try:
+            self.refresh(elastic_token)
+        except Exception:
+            logger.exception("Catalog background refresh failed")
+        finally:
+            self._refresh_lock.release()
+
+    def _ensure_loaded(self, elastic_token: str):
+        # the first request waits for the catalog, later ones are served
+        # from memory while a stale catalog is refreshed in the background
+        metrics.record_cache_lookup("catalog", hit=bool(self.pages))
+        if not self.pages:
+            with self._refresh_lock:
+                if not self.pages:
+                    self.refresh(elastic_token)
+        elif self.is_stale() and self._refresh_lock.acquire(blocking=False):
+            threading.Thread(
+                target=self._refresh_in_background, args=(elastic_token,), daemon=True
+            ).start()
+
+    def get_pages(self, elastic_token: str) -> tuple[int, list[list[dict]]]:
+        self._ensure_loaded(elastic_token)
+        with self._lock:
+            return self.version, self.pages
+
+    def get_rendered_pages(self, elastic_token: str) -> tuple[int, list]:
+        self._ensure_loaded(elastic_token)
+        with self._lock:
+            return self.version, self.rendered_pages
@@ -0,0 +1,205 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+import redis
+
+import metrics
+
+
+logger = logging.getLogger(__file__)
+
+POLL_INTERVAL = 1  # seconds
+CLAIM_BATCH_SIZE = 100
+LEASE_TIMEOUT = 60  # seconds
+FIRE_WORKERS = 8
+MAX_RUNNING_JOBS = 1000
+MAX_ATTEMPTS = 5
+FIRED_TTL = 24 * 60 * 60  # seconds
+
+# a claimed job stays in the set with its score pushed to the end of the
+# lease, so a process that dies mid-job only delays it until the lease is over;
+# the claiming process renews the lease for as long as the job runs
+CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, job_id in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[2], job_id)
+end
+return due
+"""
+
+
+class DelayedJobScheduler:
+    # timers live in a Redis sorted set scored by due time, so they survive
+    # restarts and any bot process can fire them; a callback may return a
+    # Future, and the job is done only once that Future succeeds
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        key: str = "delayed_jobs",
+        poll_interval: float = POLL_INTERVAL,
+        lease_timeout: float = LEASE_TIMEOUT,
+    ):
+        self.redis = redis_connection
+        self.key = key
+        self.jobs_key = f"{key}:jobs"
+        self.attempts_key = f"{key}:attempts"
+        self.poll_interval = poll_interval
+        self.lease_timeout = lease_timeout
+        self.callbacks = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=FIRE_WORKERS, thread_name_prefix="delayed_jobs"
+        )
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._renewed_at = 0.0
+        self._claim = self.redis.register_script(CLAIM_SCRIPT)
+        self._stopped = threading.Event()
+
+    def register(self, name: str, callback: Callable[[dict], Optional[Future]]):
+        self.callbacks[name] = callback
+
+    def schedule(self, name: str, payload: dict, delay: float, idempotency_key: str):
+        # scheduling twice with the same key keeps the first job
+        due_at = time.time() + delay
+        job = {"name": name, "payload": payload, "due_at": due_at}
+        pipeline = self.redis.pipeline()
+        pipeline.hsetnx(self.jobs_key, idempotency_key, json.dumps(job))
+        pipeline.zadd(self.key, {idempotency_key: due_at}, nx=True)
+        pipeline.execute()
+
+    def _finish(self, job_id: str):
+        pipeline = self.redis.pipeline()
+        pipeline.zrem(self.key, job_id)
+        pipeline.hdel(self.jobs_key, job_id)
+        pipeline.hdel(self.attempts_key, job_id)
+        pipeline.execute()
+
+    def _release(self, job_id: str):
+        # the lease is no longer renewed, a failed job is retried once it ends
+        with self._running_lock:
+            self._running.discard(job_id)
+
+    def _complete(self, job_id: str):
+        try:
+            self.redis.set(f"{self.key}:fired:{job_id}", 1, ex=FIRED_TTL)
+            self._finish(job_id)
+        except redis.RedisError:
+            logger.exception(f"Couldn't mark delayed job {job_id} fired")
+        finally:
+            self._release(job_id)
+
+    def _on_delivered(self, job_id: str, delivered: Future):
+        if delivered.exception() is not None:
+            logger.error(
+                f"Delayed job {job_id} failed", exc_info=delivered.exception()
+            )
+            self._release(job_id)
+            return
+        self._complete(job_id)
+
+    def _fire(self, job_id: str, raw_job: Optional[bytes], attempts: int):
+        try:
+            if raw_job is None:
+                self._complete(job_id)
+                return
+
+            job = json.loads(raw_job)
+            # a job whose lease ran out mid-run may be claimed again
+            if self.redis.exists(f"{self.key}:fired:{job_id}"):
+                self._complete(job_id)
+                return
+            if attempts > MAX_ATTEMPTS:
+                logger.error(
+                    f"Dropping delayed job {job_id} after {MAX_ATTEMPTS} attempts"
+                )
+                self._complete(job_id)
+                return
+
+            metrics.record_delayed_job_lag(job["name"], time.time() - job["due_at"])
+            result = self.callbacks[job["name"]](job["payload"])
+        except Exception:
+            logger.exception(f"Delayed job {job_id} failed")
+            self._release(job_id)
+            return
+
+        if isinstance(result, Future):
+            # handed off, the lease is renewed until the Future settles
+            result.add_done_callback(
+                lambda delivered: self._on_delivered(job_id, delivered)
+            )
+        else:
+            self._complete(job_id)
+
+    def renew_leases(self):
+        with self._running_lock:
+            job_ids = list(self._running)
+        if not job_ids:
+            return
+        # xx leaves alone jobs that were finished in the meantime
+        self.redis.zadd(
+            self.key,
+            {job_id: time.time() + self.lease_timeout for job_id in job_ids},
+            xx=True,
+        )
+
+    def run_due_jobs(self) -> int:
+        with self._running_lock:
+            batch_size = min(CLAIM_BATCH_SIZE, MAX_RUNNING_JOBS - len(self._running))
+        if batch_size <= 0:
+            return 0
+
+        now = time.time()
+        job_ids = self._claim(
+            keys=[self.key],
+            args=[now, now + self.lease_timeout, batch_size],
+        )
+        if not job_ids:
+            return 0
+
+        pipeline = self.redis.pipeline()
+        pipeline.hmget(self.jobs_key, job_ids)
+        for job_id in job_ids:
+            pipeline.hincrby(self.attempts_key, job_id, 1)
+        raw_jobs, *attempts = pipeline.execute()
+
+        for job_id, raw_job, job_attempts in zip(job_ids, raw_jobs, attempts):
+            job_id = job_id.decode()
+            with self._running_lock:
+                self._running.add(job_id)
+            self.executor.submit(self._fire, job_id, raw_job, job_attempts)
+
+        return len(job_ids)
+
+    def get_lag(self) -> float:
+        # how far behind the oldest due job is, zero when nothing is overdue
+        oldest = self.redis.zrange(self.key, 0, 0, withscores=True)
+        if not oldest:
+            return 0.0
+        _, due_at = oldest[0]
+        return max(0.0, time.time() - due_at)
+
+    def get_pending_count(self) -> int:
+        return self.redis.zcard(self.key)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if time.monotonic() - self._renewed_at >= self.lease_timeout / 3:
+                    self.renew_leases()
+                    self._renewed_at = time.monotonic()
+                if self.run_due_jobs() == CLAIM_BATCH_SIZE:
+                    continue
+            except redis.RedisError:
+                logger.exception("Delayed job scheduler lost Redis")
+            self._stopped.wait(self.poll_interval)
+
+    def start(self):
+        threading.Thread(target=self._run, name="delayed_jobs", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        self.executor.shutdown(wait=False)
@@ -1,11 +1,178 @@
+import os
+import re
 import time
 import urllib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+from typing import Iterator, Optional
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import resilience
+
+
+DEFAULT_ELASTIC_API_URL = "https://api.moltin.com"
+PAGE_LIMIT = 100
+PAGE_FETCH_CONCURRENCY = 4
+
+POOL_SIZE = 16
+REQUEST_TIMEOUT = (3.05, 10)  # connect, read seconds
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_FACTOR = 0.3
+ENDPOINT_TIMEOUTS = {
+    "POST /oauth/access_token": (3.05, 5),
+    "GET /v2/products": (3.05, 15),
+    "POST /v2/files": (3.05, 30),
+}
+# reads that may be answered with the last good response while Moltin is down
+STALE_READ_ENDPOINTS = re.compile(
+    r"GET /v2/(products(/\{id\})?|files/\{id\}|flows/pizzeria/entries)"
+)
+
+moltin_guard = resilience.ServiceGuard("moltin")
+
+
+def get_api_url() -> str:
+    # read on every call, so .env loaded by the entry point is respected
+    return os.getenv("ELASTIC_API_URL", DEFAULT_ELASTIC_API_URL)
+
+
+def get_endpoint_name(method: str, url: str) -> str:
+    return f"{method} {metrics.get_endpoint(urlparse(url).path)}"
+
+
+def build_stale_response(request: requests.PreparedRequest, body: bytes):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = body
+    response.headers["Content-Type"] = "application/json"
+    response.headers["X-Stale"] = "1"
+    response.encoding = "utf-8"
+    response.url = request.url
+    response.request = request
+    response.elapsed = timedelta(0)
+    return response
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, *args, timeout=REQUEST_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        endpoint = get_endpoint_name(request.method, request.url)
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = ENDPOINT_TIMEOUTS.get(endpoint, self.timeout)
+        return super().send(request, **kwargs)
+
+
+class ResilientHTTPAdapter(TimeoutHTTPAdapter):
+    # every call goes through the Moltin breaker and rate limiter, failed
+    # reads are answered with the last good response when there is one
+    @staticmethod
+    def _get_stale_response(request, endpoint: str) -> Optional[requests.Response]:
+        if not STALE_READ_ENDPOINTS.fullmatch(endpoint):
+            return None
+        stale_body = moltin_guard.get_stale(request.url)
+        metrics.record_cache_lookup("moltin_stale", hit=stale_body is not None)
+        if stale_body is None:
+            return None
+        return build_stale_response(request, stale_body)
+
+    def send(self, request, **kwargs):
+        endpoint = get_endpoint_name(request.method, request.url)
+        try:
+            is_trial, delay = moltin_guard.admit(endpoint)
+        except resilience.ServiceUnavailableError:
+            stale_response = self._get_stale_response(request, endpoint)
+            if stale_response is None:
+                raise
+            return stale_response
+        try:
+            if delay:
+                time.sleep(delay)
+
+            try:
+                response = super().send(request, **kwargs)
+            except requests.RequestException:
+                moltin_guard.record(endpoint, is_trial, status_code=None)
+                stale_response = self._get_stale_response(request, endpoint)
+                if stale_response is None:
+                    raise
+                return stale_response
+
+            is_failure = moltin_guard.record(
+                endpoint, is_trial, response.status_code, response.headers
+            )
+            if is_failure:
+                return self._get_stale_response(request, endpoint) or response
+            if response.status_code == 200 and STALE_READ_ENDPOINTS.fullmatch(endpoint):
+                moltin_guard.store_stale(request.url, response.content)
+
+            return response
+        finally:
+            moltin_guard.release(endpoint, is_trial)
+
+
+def record_response(response: requests.Response, *args, **kwargs):
+    metrics.record_api_call(
+        service="moltin",
+        endpoint=get_endpoint_name(response.request.method, response.url),
+        status="stale" if "X-Stale" in response.headers else str(response.status_code),
+        seconds=response.elapsed.total_seconds(),
+    )
+
+
+def create_session(
+    pool_size: int = POOL_SIZE,
+    timeout: tuple[float, float] = REQUEST_TIMEOUT,
+    retry_attempts: int = RETRY_ATTEMPTS,
+    backoff_factor: float = RETRY_BACKOFF_FACTOR,
+) -> requests.Session:
+    # only idempotent methods are retried, so a cart item is never added twice
+    retry = Retry(
+        total=retry_attempts,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    adapter = ResilientHTTPAdapter(
+        timeout=timeout,
+        max_retries=retry,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+    )
+    new_session = requests.Session()
+    new_session.mount("https://", adapter)
+    new_session.mount("http://", adapter)
+    new_session.hooks["response"].append(record_response)
+
+    return new_session
+
+
+session = create_session()
+
+
+def configure_session(**session_options):
+    global session
+    old_session, session = session, create_session(**session_options)
+    old_session.close()
+
+
+@lru_cache(maxsize=8)
+def get_auth_headers(credential_token: str) -> dict:
+    return {"Authorization": f"Bearer {credential_token}"}
 
 
 def get_json_data(url: str) -> list[dict]:
-    response = requests.get(url)
+    response = session.get(url)
     response.raise_for_status()
 
     return response.json()
@@ -18,7 +185,7 @@ def get_credential_token(client_id: str, client_secret: str) -> dict:
         "grant_type": "client_credentials",
     }
 
-    response = requests.post(url="https://api.moltin.com/oauth/access_token", data=data)
+    response = session.post(url=f"{get_api_url()}/oauth/access_token", data=data)
     response.raise_for_status()
 
     return response.json()
@@ -32,15 +199,15 @@ def get_new_credential_token(
         return new_credential_token
 
 
-def get_all_products(credential_token: str) -> list[dict]:
-    headers = {"Authorization": f"Bearer {credential_token}"}
+def get_page(credential_token: str, url: str, offset: int = 0) -> dict:
+    headers = get_auth_headers(credential_token)
     payload = {
-        "page[limit]": "100",
-        "page[offset]": "0",
+        "page[limit]": str(PAGE_LIMIT),
+        "page[offset]": str(offset),
     }
 
-    response = requests.get(
-        url="https://api.moltin.com/v2/products",
+    response = session.get(
+        url=url,
         headers=headers,
         params=urllib.parse.urlencode(payload, safe="[]"),
     )
@@ -49,8 +216,77 @@ def get_all_products(credential_token: str) -> list[dict]:
     return response.json()
 
 
+def iterate_pages(
+    credential_token: str, url: str, concurrency: int = PAGE_FETCH_CONCURRENCY
+) -> Iterator[dict]:
+    first_page = get_page(credential_token=credential_token, url=url)
+    yield from first_page["data"]
+
+    meta = first_page.get("meta", {})
+    total = meta.get("results", {}).get("total")
+    limit = meta.get("page", {}).get("limit", PAGE_LIMIT)
+
+    # total is unknown, so follow the links one page after another
+    if total is None:
+        next_url = first_page.get("links", {}).get("next")
+        while next_url:
+            response = session.get(
+                next_url, headers=get_auth_headers(credential_token)
+            )
+            response.raise_for_status()
+            page = response.json()
+            yield from page["data"]
+            next_url = page.get("links", {}).get("next")
+        return
+
+    # total is known, so fetch the next pages concurrently, keeping at most
+    # `concurrency` pages in flight and yielding them in catalog order
+    offsets = iter(range(limit, total, limit))
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = deque()
+    try:
+        for offset in offsets:
+            pending.append(executor.submit(get_page, credential_token, url, offset))
+            if len(pending) >= concurrency:
+                break
+        while pending:
+            page = pending.popleft().result()
+            next_offset = next(offsets, None)
+            if next_offset is not None:
+                pending.append(
+                    executor.submit(get_page, credential_token, url, next_offset)
+                )
+            yield from page["data"]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iterate_products(credential_token: str) -> Iterator[dict]:
+    yield from iterate_pages(
+        credential_token=credential_token, url=f"{get_api_url()}/v2/products"
+    )
+
+
+def iterate_entries(credential_token: str, slug: str) -> Iterator[dict]:
+    yield from iterate_pages(
+        credential_token=credential_token,
+        url=f"{get_api_url()}/v2/flows/{slug}/entries",
+    )
+
+
+def iterate_cart_items(credential_token: str, cart_id: str) -> Iterator[dict]:
+    yield from iterate_pages(
+        credential_token=credential_token,
+        url=f"{get_api_url()}/v2/carts/{cart_id}/items",
+    )
+
+
+def get_all_products(credential_token: str) -> dict:
+    return {"data": list(iterate_products(credential_token=credential_token))}
+
+
 def create_product(credential_token: str, product_details: dict, sku: int) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
+    headers = get_auth_headers(credential_token)
     json_data = {
         "data": {
             "type": "product",
@@ -71,8 +307,8 @@ def create_product(credential_token: str, product_details: dict, sku: int) -> di
         },
     }
 
-    response = requests.post(
-        "https://api.moltin.com/v2/products", headers=headers, json=json_data
+    response = session.post(
+        f"{get_api_url()}/v2/products", headers=headers, json=json_data
     )
     response.raise_for_status()
 
@@ -80,12 +316,12 @@ def create_product(credential_token: str, product_details: dict, sku: int) -> di
 
 
 def create_pizza_image(credential_token: str, image_url: str) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
+    headers = get_auth_headers(credential_token)
     files = {
         "file_location": (None, image_url),
     }
-    response = requests.post(
-        "https://api.moltin.com/v2/files", headers=headers, files=files
+    response = session.post(
+        f"{get_api_url()}/v2/files", headers=headers, files=files
     )
     response.raise_for_status()
 
@@ -95,15 +331,15 @@ def create_pizza_image(credential_token: str, image_url: str) -> dict:
 def create_pizza_image_relationship(
     credential_token: str, product_id: str, image_id: str
 ):
-    headers = {"Authorization": f"Bearer {credential_token}"}
+    headers = get_auth_headers(credential_token)
     json_data = {
         "data": {
             "type": "main_image",
             "id": image_id,
         },
     }
-    response = requests.post(
-        f"https://api.moltin.com/v2/products/{product_id}/relationships/main-image",
+    response = session.post(
+        f"{get_api_url()}/v2/products/{product_id}/relationships/main-image",
         headers=headers,
         json=json_data,
     )
@@ -112,28 +348,8 @@ def create_pizza_image_relationship(
     return response.json()
 
 
-def create_all_pizza_image_relations(
-    credential_token: str,
-    all_products: list[dict],
-    pizza_menus_data: list[dict],
-):
-    for pizza in pizza_menus_data:
-        for product in all_products["data"]:
-            if pizza.get("name") == product.get("name"):
-                pizza_image = create_pizza_image(
-                    credential_token=credential_token,
-                    image_url=pizza["product_image"]["url"],
-                )
-                pizza_image_id = pizza_image["data"]["id"]
-                create_pizza_image_relationship(
-                    credential_token=credential_token,
-                    product_id=product["id"],
-                    image_id=pizza_image_id,
-                )
-
-
 def create_flow(credential_token: str, name: str, slug: str, description: str) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
+    headers = get_auth_headers(credential_token)
     json_data = {
         "data": {
             "type": "flow",
@@ -144,8 +360,8 @@ def create_flow(credential_token: str, name: str, slug: str, description: str) -
         },
     }
 
-    response = requests.post(
-        "https://api.moltin.com/v2/flows", headers=headers, json=json_data
+    response = session.post(
+        f"{get_api_url()}/v2/flows", headers=headers, json=json_data
     )
     response.raise_for_status()
 
@@ -155,7 +371,7 @@ def create_flow(credential_token: str, name: str, slug: str, description: str) -
 def create_field(
     credential_token: str, name: str, slug: str, description: str, flow_id: str
 ) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
+    headers = get_auth_headers(credential_token)
     json_data = {
         "data": {
             "type": "field",
@@ -176,8 +392,8 @@ def create_field(
         },
     }
 
-    response = requests.post(
-        "https://api.moltin.com/v2/fields", headers=headers, json=json_data
+    response = session.post(
+        f"{get_api_url()}/v2/fields", headers=headers, json=json_data
     )
     response.raise_for_status()
 
@@ -193,7 +409,7 @@ def create_pizzeria_entry(
     latitude: str,
 ):
     headers = {
-        "Authorization": f"Bearer {credential_token}",
+        **get_auth_headers(credential_token),
         "Content-Type": "application/json",
     }
     json_data = {
@@ -206,8 +422,8 @@ def create_pizzeria_entry(
         }
     }
 
-    response = requests.post(
-        f"https://api.moltin.com/v2/flows/{pizzeria_slug}/entries",
+    response = session.post(
+        f"{get_api_url()}/v2/flows/{pizzeria_slug}/entries",
         headers=headers,
         json=json_data,
     )
@@ -219,7 +435,7 @@ def create_pizzeria_entry(
 def add_product_to_cart(
     credential_token: str, product_id: str, quantity: int, cart_id: str
 ) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
+    headers = get_auth_headers(credential_token)
     json_data = {
         "data": {
             "id": product_id,
@@ -227,8 +443,8 @@ def add_product_to_cart(
             "quantity": quantity,
         }
     }
-    response = requests.post(
-        f"https://api.moltin.com/v2/carts/{cart_id}/items",
+    response = session.post(
+        f"{get_api_url()}/v2/carts/{cart_id}/items",
         headers=headers,
         json=json_data,
     )
@@ -240,9 +456,9 @@ def add_product_to_cart(
 def delete_product_from_cart(
     credential_token: str, cart_id: str, product_id: str
 ) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
-    response = requests.delete(
-        f"https://api.moltin.com/v2/carts/{cart_id}/items/{product_id}", headers=headers
+    headers = get_auth_headers(credential_token)
+    response = session.delete(
+        f"{get_api_url()}/v2/carts/{cart_id}/items/{product_id}", headers=headers
     )
     response.raise_for_status()
 
@@ -250,9 +466,9 @@ def delete_product_from_cart(
 
 
 def get_cart(credential_token: str, cart_id: str) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
-    response = requests.get(
-        f"https://api.moltin.com/v2/carts/{cart_id}", headers=headers
+    headers = get_auth_headers(credential_token)
+    response = session.get(
+        f"{get_api_url()}/v2/carts/{cart_id}", headers=headers
     )
     response.raise_for_status()
 
@@ -260,19 +476,17 @@ def get_cart(credential_token: str, cart_id: str) -> dict:
 
 
 def get_cart_items(credential_token: str, cart_id: str) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
-    response = requests.get(
-        f"https://api.moltin.com/v2/carts/{cart_id}/items", headers=headers
-    )
-    response.raise_for_status()
-
-    return response.json()
+    return {
+        "data": list(
+            iterate_cart_items(credential_token=credential_token, cart_id=cart_id)
+        )
+    }
 
 
 def get_product(credential_token: str, product_id: str) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
-    response = requests.get(
-        f"https://api.moltin.com/v2/products/{product_id}", headers=headers
+    headers = get_auth_headers(credential_token)
+    response = session.get(
+        f"{get_api_url()}/v2/products/{product_id}", headers=headers
     )
     response.raise_for_status()
 
@@ -280,9 +494,9 @@ def get_product(credential_token: str, product_id: str) -> dict:
 
 
 def get_file_href(credential_token: str, file_id: str) -> str:
-    headers = {"Authorization": f"Bearer {credential_token}"}
-    response = requests.get(
-        f"https://api.moltin.com/v2/files/{file_id}", headers=headers
+    headers = get_auth_headers(credential_token)
+    response = session.get(
+        f"{get_api_url()}/v2/files/{file_id}", headers=headers
     )
     response.raise_for_status()
     file_details = response.json()["data"]
@@ -291,7 +505,7 @@ def get_file_href(credential_token: str, file_id: str) -> str:
 
 
 def create_customer(credential_token: str, user_id: str, email: str) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
+    headers = get_auth_headers(credential_token)
     payload = {
         "data": {
             "type": "customer",
@@ -301,8 +515,8 @@ def create_customer(credential_token: str, user_id: str, email: str) -> dict:
         },
     }
 
-    response = requests.post(
-        "https://api.moltin.com/v2/customers", headers=headers, json=payload
+    response = session.post(
+        f"{get_api_url()}/v2/customers", headers=headers, json=payload
     )
     response.raise_for_status()
 
@@ -310,23 +524,19 @@ def create_customer(credential_token: str, user_id: str, email: str) -> dict:
 
 
 def get_customer(credential_token: str, customer_id: str) -> dict:
-    headers = {"Authorization": f"Bearer {credential_token}"}
-    response = requests.get(
-        f"https://api.moltin.com/v2/customers/{customer_id}", headers=headers
+    headers = get_auth_headers(credential_token)
+    response = session.get(
+        f"{get_api_url()}/v2/customers/{customer_id}", headers=headers
     )
     response.raise_for_status()
 
     return response.json()
 
 
-def get_all_entries(credential_token: str, slug: str) -> list[dict]:
-    headers = {"Authorization": f"Bearer {credential_token}"}
-    response = requests.get(
-        f"https://api.moltin.com/v2/flows/{slug}/entries", headers=headers
-    )
-    response.raise_for_status()
-
-    return response.json()
+def get_all_entries(credential_token: str, slug: str) -> dict:
+    return {
+        "data": list(iterate_entries(credential_token=credential_token, slug=slug))
+    }
 
 
 def create_coordinates_entry(
@@ -337,7 +547,7 @@ def create_coordinates_entry(
     latitude: str,
 ):
     headers = {
-        "Authorization": f"Bearer {credential_token}",
+        **get_auth_headers(credential_token),
         "Content-Type": "application/json",
     }
     json_data = {
@@ -349,8 +559,8 @@ def create_coordinates_entry(
         }
     }
 
-    response = requests.post(
-        f"https://api.moltin.com/v2/flows/{coordinates_slug}/entries",
+    response = session.post(
+        f"{get_api_url()}/v2/flows/{coordinates_slug}/entries",
         headers=headers,
         json=json_data,
     )
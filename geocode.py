@@ -1,17 +1,77 @@
+import os
+import re
+import threading
+import time
+
+import numpy as np
+import redis
 import requests
 from geopy import distance
 
+import metrics
+import resilience
+
+
+DEFAULT_GEOCODER_URL = "https://geocode-maps.yandex.ru/1.x"
+EARTH_RADIUS_KM = 6371.0088
+HAVERSINE_ERROR = 0.006
+GEOCODE_TIMEOUT = (3.05, 5)  # connect, read seconds
+
+GEOCODE_CACHE_TTL = 30 * 24 * 60 * 60  # seconds
+GEOCODE_NEGATIVE_CACHE_TTL = 24 * 60 * 60  # seconds
+GEOCODE_STATS_KEY = "geocode:stats"
+ADDRESS_ABBREVIATIONS = {
+    "г": "город",
+    "ул": "улица",
+    "пр": "проспект",
+    "пр-т": "проспект",
+    "пр-кт": "проспект",
+    "пер": "переулок",
+    "пл": "площадь",
+    "б-р": "бульвар",
+    "бул": "бульвар",
+    "наб": "набережная",
+    "ш": "шоссе",
+    "д": "дом",
+    "к": "корпус",
+    "корп": "корпус",
+    "стр": "строение",
+}
+
+yandex_guard = resilience.ServiceGuard("yandex")
+
+
+def get_geocoder_url() -> str:
+    # main() loads .env only after this module is imported
+    return os.getenv("GEOCODER_URL", DEFAULT_GEOCODER_URL)
+
 
 def get_coordinates(yandex_token: str, address: str) -> tuple[str, str]:
-    response = requests.get(
-        url="https://geocode-maps.yandex.ru/1.x",
-        params={
-            "geocode": address,
-            "apikey": yandex_token,
-            "format": "json",
-        },
-    )
-    response.raise_for_status()
+    is_trial, delay = yandex_guard.admit("geocode")
+    try:
+        if delay:
+            time.sleep(delay)
+
+        with metrics.track_api_call("yandex", "geocode"):
+            try:
+                response = requests.get(
+                    url=get_geocoder_url(),
+                    params={
+                        "geocode": address,
+                        "apikey": yandex_token,
+                        "format": "json",
+                    },
+                    timeout=GEOCODE_TIMEOUT,
+                )
+            except requests.RequestException:
+                yandex_guard.record("geocode", is_trial, status_code=None)
+                raise
+            yandex_guard.record(
+                "geocode", is_trial, response.status_code, response.headers
+            )
+            response.raise_for_status()
+    finally:
+        yandex_guard.release("geocode", is_trial)
 
     found_places = response.json()["response"]["GeoObjectCollection"]["featureMember"]
     most_relevant = found_places[0]
@@ -20,14 +80,166 @@ def get_coordinates(yandex_token: str, address: str) -> tuple[str, str]:
     return longitude, latitude
 
 
-def get_nearest_pizzeria(user_coordinates: tuple[str, str], pizzerias: list[dict]):
-    for pizzeria in pizzerias:
-        pizzeria_coordinates = (
-            pizzeria["longitude"],
-            pizzeria["latitude"],
+def normalize_address(address: str) -> str:
+    words = re.findall(r"[\w-]+", address.casefold().replace("ё", "е"))
+    return " ".join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
+
+def get_cached_coordinates(
+    redis_connection: redis.Redis, yandex_token: str, address: str
+) -> tuple[str, str]:
+    # unknown addresses are cached as an empty value and raise IndexError
+    # just like get_coordinates does when nothing was found
+    cache_key = f"geocode:address:{normalize_address(address)}"
+    cached_coordinates = redis_connection.get(cache_key)
+    metrics.record_cache_lookup("geocode", hit=cached_coordinates is not None)
+
+    if cached_coordinates == b"":
+        redis_connection.hincrby(GEOCODE_STATS_KEY, "negative_hits")
+        raise IndexError(f"Address not found: {address}")
+    if cached_coordinates is not None:
+        redis_connection.hincrby(GEOCODE_STATS_KEY, "hits")
+        longitude, latitude = cached_coordinates.decode().split(" ")
+        return longitude, latitude
+
+    redis_connection.hincrby(GEOCODE_STATS_KEY, "misses")
+    started_at = time.perf_counter()
+    try:
+        longitude, latitude = get_coordinates(
+            yandex_token=yandex_token, address=address
+        )
+    except IndexError:
+        redis_connection.set(cache_key, "", ex=GEOCODE_NEGATIVE_CACHE_TTL)
+        raise
+    finally:
+        redis_connection.hincrbyfloat(
+            GEOCODE_STATS_KEY, "api_seconds", time.perf_counter() - started_at
+        )
+
+    redis_connection.set(cache_key, f"{longitude} {latitude}", ex=GEOCODE_CACHE_TTL)
+
+    return longitude, latitude
+
+
+def get_geocode_stats(redis_connection: redis.Redis) -> dict:
+    stats = redis_connection.hgetall(GEOCODE_STATS_KEY)
+    return {key.decode(): float(value) for key, value in stats.items()}
+
+
+class PizzeriaIndex:
+    # hundreds of pizzerias fit in a few NumPy arrays, so a vectorized
+    # haversine scan is faster than walking a tree; only the closest
+    # candidates get the exact (and slow) geodesic distance
+    def __init__(self, pizzerias: list[dict] = ()):
+        self._pizzerias = {}
+        self._positions = {}
+        # pizzeria dicts in the order of the coordinate arrays; all three are
+        # replaced rather than changed in place, so a lookup holds a
+        # consistent snapshot without the lock
+        self._rows = []
+        self._latitudes = np.empty(0)
+        self._longitudes = np.empty(0)
+        self._lock = threading.Lock()
+        self.sync(pizzerias)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get_pizzerias(self) -> list[dict]:
+        with self._lock:
+            return list(self._pizzerias.values())
+
+    def sync(self, pizzerias: list[dict]):
+        pizzerias = {pizzeria["id"]: pizzeria for pizzeria in pizzerias}
+        with self._lock:
+            if pizzerias == self._pizzerias:
+                return
+            self._pizzerias = pizzerias
+            self._rebuild()
+
+    def upsert(self, pizzeria: dict):
+        with self._lock:
+            if self._pizzerias.get(pizzeria["id"]) == pizzeria:
+                return
+            self._pizzerias[pizzeria["id"]] = pizzeria
+
+            rows = list(self._rows)
+            latitudes, longitudes = self._latitudes.copy(), self._longitudes.copy()
+            latitude = np.radians(float(pizzeria["latitude"]))
+            longitude = np.radians(float(pizzeria["longitude"]))
+            position = self._positions.get(pizzeria["id"])
+            if position is None:
+                self._positions[pizzeria["id"]] = len(rows)
+                rows.append(pizzeria)
+                latitudes = np.append(latitudes, latitude)
+                longitudes = np.append(longitudes, longitude)
+            else:
+                rows[position] = pizzeria
+                latitudes[position], longitudes[position] = latitude, longitude
+            self._rows, self._latitudes, self._longitudes = rows, latitudes, longitudes
+
+    def remove(self, pizzeria_id: str):
+        with self._lock:
+            if self._pizzerias.pop(pizzeria_id, None) is not None:
+                self._rebuild()
+
+    def _rebuild(self):
+        rows = list(self._pizzerias.values())
+        self._positions = {pizzeria["id"]: index for index, pizzeria in enumerate(rows)}
+        latitudes = np.radians([float(pizzeria["latitude"]) for pizzeria in rows])
+        longitudes = np.radians([float(pizzeria["longitude"]) for pizzeria in rows])
+        self._rows, self._latitudes, self._longitudes = rows, latitudes, longitudes
+
+    def _haversine(self, user_coordinates: tuple[str, str]) -> tuple[list, np.ndarray]:
+        longitude, latitude = map(float, user_coordinates)
+        latitude, longitude = np.radians(latitude), np.radians(longitude)
+        with self._lock:
+            rows, latitudes, longitudes = self._rows, self._latitudes, self._longitudes
+
+        a = (
+            np.sin((latitudes - latitude) / 2) ** 2
+            + np.cos(latitude)
+            * np.cos(latitudes)
+            * np.sin((longitudes - longitude) / 2) ** 2
         )
-        pizzeria["distance"] = round(
-            distance.distance(user_coordinates, pizzeria_coordinates).km, 1
+        return rows, 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+    def _with_distance(self, user_coordinates: tuple[str, str], pizzeria: dict) -> dict:
+        longitude, latitude = user_coordinates
+        pizzeria_distance = distance.distance(
+            (latitude, longitude), (pizzeria["latitude"], pizzeria["longitude"])
+        ).km
+
+        return {**pizzeria, "distance": round(pizzeria_distance, 1)}
+
+    def nearest(self, user_coordinates: tuple[str, str], k: int = 1) -> list[dict]:
+        rows, distances = self._haversine(user_coordinates)
+        if not rows:
+            return []
+
+        k = min(k, len(rows))
+        kth_distance = np.partition(distances, k - 1)[k - 1]
+        # haversine is off the geodesic by well under a percent,
+        # so anything farther than that can't make the top k
+        candidates = np.flatnonzero(
+            distances <= kth_distance * (1 + HAVERSINE_ERROR) + 1e-9
         )
+        pizzerias = [
+            self._with_distance(user_coordinates, rows[index]) for index in candidates
+        ]
+
+        return sorted(pizzerias, key=lambda pizzeria: pizzeria["distance"])[:k]
 
-    return min(pizzerias, key=lambda x: x["distance"])
+    def within_radius(
+        self, user_coordinates: tuple[str, str], radius_km: float
+    ) -> list[dict]:
+        rows, distances = self._haversine(user_coordinates)
+        candidates = np.flatnonzero(distances <= radius_km * (1 + HAVERSINE_ERROR))
+        pizzerias = [
+            self._with_distance(user_coordinates, rows[index]) for index in candidates
+        ]
+
+        return sorted(
+            [pizzeria for pizzeria in pizzerias if pizzeria["distance"] <= radius_km],
+            key=lambda pizzeria: pizzeria["distance"],
+        )
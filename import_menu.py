@@ -0,0 +1,150 @@
+import argparse
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+import elastic_api
+
+
+logger = logging.getLogger(__file__)
+
+IMPORT_WORKERS = 8
+CHECKPOINT_PATH = "import_checkpoint.json"
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self.pizzas = json.load(file)
+        except FileNotFoundError:
+            self.pizzas = {}
+
+    def get(self, slug: str) -> dict:
+        with self._lock:
+            return dict(self.pizzas.get(slug, {}))
+
+    def update(self, slug: str, **progress):
+        with self._lock:
+            self.pizzas.setdefault(slug, {}).update(progress)
+            # write a temporary file first so a crash never leaves a torn checkpoint
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, "w") as file:
+                json.dump(self.pizzas, file, ensure_ascii=False, indent=2)
+            os.replace(temporary_path, self.path)
+
+
+def index_products(products: list[dict]) -> dict:
+    products_index = {}
+    for product in products:
+        products_index[product["slug"]] = product
+        products_index[product["name"]] = product
+
+    return products_index
+
+
+def import_pizza(
+    credential_token: str, pizza: dict, products_index: dict, checkpoint: Checkpoint
+):
+    slug = str(pizza["id"])
+    progress = checkpoint.get(slug)
+    if progress.get("linked"):
+        return
+
+    product = products_index.get(slug) or products_index.get(pizza["name"])
+    if product:
+        product_id = product["id"]
+        if product.get("relationships", {}).get("main_image"):
+            checkpoint.update(slug, product_id=product_id, linked=True)
+            return
+    elif progress.get("product_id"):
+        product_id = progress["product_id"]
+    else:
+        product = elastic_api.create_product(
+            credential_token=credential_token, product_details=pizza, sku=pizza["id"]
+        )
+        product_id = product["data"]["id"]
+    checkpoint.update(slug, product_id=product_id)
+
+    image_id = progress.get("image_id")
+    if not image_id:
+        pizza_image = elastic_api.create_pizza_image(
+            credential_token=credential_token,
+            image_url=pizza["product_image"]["url"],
+        )
+        image_id = pizza_image["data"]["id"]
+        checkpoint.update(slug, image_id=image_id)
+
+    elastic_api.create_pizza_image_relationship(
+        credential_token=credential_token, product_id=product_id, image_id=image_id
+    )
+    checkpoint.update(slug, linked=True)
+
+
+def import_menu(
+    credential_token: str,
+    pizza_menus_data: list[dict],
+    checkpoint: Checkpoint,
+    workers: int = IMPORT_WORKERS,
+) -> int:
+    products_index = index_products(
+        elastic_api.iterate_products(credential_token=credential_token)
+    )
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                import_pizza, credential_token, pizza, products_index, checkpoint
+            ): pizza
+            for pizza in pizza_menus_data
+        }
+        for future in as_completed(futures):
+            pizza = futures[future]
+            try:
+                future.result()
+            except Exception:
+                failed += 1
+                logger.exception(f"Failed to import {pizza.get('name')}")
+
+    return failed
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Import pizzas and their images into Elasticpath"
+    )
+    parser.add_argument("menu_url", help="URL of the pizza menu JSON")
+    parser.add_argument("--workers", type=int, default=IMPORT_WORKERS)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    args = parser.parse_args()
+
+    elastic_token = elastic_api.get_credential_token(
+        client_id=os.getenv("ELASTIC_CLIENT_ID"),
+        client_secret=os.getenv("ELASTIC_CLIENT_SECRET"),
+    )
+    elastic_api.configure_session(pool_size=args.workers)
+
+    failed = import_menu(
+        credential_token=elastic_token["access_token"],
+        pizza_menus_data=elastic_api.get_json_data(args.menu_url),
+        checkpoint=Checkpoint(args.checkpoint),
+        workers=args.workers,
+    )
+    if failed:
+        logger.error(f"{failed} pizzas failed, run again to resume")
+    else:
+        logger.info("Menu imported")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,55 @@
+import asyncio
 from textwrap import dedent
+from typing import Optional
 
-from more_itertools import chunked
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+import async_elastic_api
 import elastic_api
 import geocode
+from cart_mirror import CartMirror
+from catalog import CatalogCache
+from product_cache import ProductCache
+from search import ProductSearchIndex
+from write_behind import CoordinatesWriter
 
 
-PRODUCTS_ON_MENU_PAGE = 8
+def get_menu_page_markup(
+    page_products: list[dict], current_page: int, total_pages: int
+) -> str:
+    next_page, prev_page = current_page + 1, current_page - 1
+    # cycle through pages
+    if current_page == total_pages:
+        next_page = 1
+    elif current_page == 1:
+        prev_page = total_pages
+
+    keyboard = []
+    for product in page_products:
+        keyboard.append(
+            [InlineKeyboardButton(text=product["name"], callback_data=product["id"])]
+        )
+    keyboard.append(
+        [
+            InlineKeyboardButton("<-", callback_data=f"page {prev_page}"),
+            InlineKeyboardButton("Корзина", callback_data="cart"),
+            InlineKeyboardButton("->", callback_data=f"page {next_page}"),
+        ]
+    )
+    keyboard.append(
+        [InlineKeyboardButton("Поиск", switch_inline_query_current_chat="")]
+    )
+
+    # serialized once here, Telegram accepts the JSON string as reply_markup
+    return InlineKeyboardMarkup(keyboard).to_json()
 
 
 def get_menu_markup(
+    catalog: CatalogCache,
     elastic_token: str,
     user_first_name: str,
     button_pressed: str,
-) -> tuple[str, InlineKeyboardMarkup]:
+) -> tuple[str, str]:
     welcome_text = f"""
             Привет, {user_first_name}! 
             Добро пожаловать в пиццерию "Pizza time"!
@@ -26,43 +61,47 @@ def get_menu_markup(
         _, current_page = button_pressed.split(" ")
         current_page = int(current_page)
 
-    products = elastic_api.get_all_products(credential_token=elastic_token)
-    product_chunks = list(chunked(iterable=products["data"], n=PRODUCTS_ON_MENU_PAGE))
-    product_buttons_details = [
-        (product["name"], product["id"]) for product in product_chunks[current_page - 1]
-    ]
+    _, menu_page_markups = catalog.get_rendered_pages(elastic_token=elastic_token)
+    # catalog could have shrunk since the page button was rendered
+    if current_page > len(menu_page_markups):
+        current_page = 1
 
-    total_pages = len(product_chunks)
-    next_page, prev_page = current_page + 1, current_page - 1
-    # cycle through pages
-    if current_page == total_pages:
-        next_page = 1
-    elif current_page == 1:
-        prev_page = total_pages
+    return welcome_text, menu_page_markups[current_page - 1]
 
-    keyboard = []
-    for product in product_buttons_details:
-        product_name, product_id = product
-        keyboard.append(
-            [InlineKeyboardButton(text=product_name, callback_data=product_id)]
+
+def get_search_results(
+    catalog: CatalogCache,
+    search_index: ProductSearchIndex,
+    elastic_token: str,
+    query: str,
+) -> list[dict]:
+    catalog_version, pages = catalog.get_pages(elastic_token=elastic_token)
+    if search_index.catalog_version != catalog_version:
+        search_index.sync(
+            [product for page in pages for product in page],
+            catalog_version=catalog_version,
         )
-    keyboard.append(
-        [
-            InlineKeyboardButton("<-", callback_data=f"page {prev_page}"),
-            InlineKeyboardButton("Корзина", callback_data="cart"),
-            InlineKeyboardButton("->", callback_data=f"page {next_page}"),
-        ]
-    )
-    menu_markup = InlineKeyboardMarkup(keyboard)
 
-    return welcome_text, menu_markup
+    return search_index.search(query)
 
 
-def get_product_in_cart_count(elastic_token: str, product_id: str, cart_id: str) -> int:
-    cart_items = elastic_api.get_cart_items(
-        credential_token=elastic_token, cart_id=cart_id
-    )
-    product_in_cart_count = sum(
+def get_search_markup(found_products: list[dict]) -> tuple[str, InlineKeyboardMarkup]:
+    if found_products:
+        search_text = "Вот что нашлось:"
+    else:
+        search_text = "Ничего не нашлось, попробуйте по-другому."
+
+    keyboard = [
+        [InlineKeyboardButton(text=product["name"], callback_data=product["id"])]
+        for product in found_products
+    ]
+    keyboard.append([InlineKeyboardButton(text="В меню", callback_data="back")])
+
+    return search_text, InlineKeyboardMarkup(keyboard)
+
+
+def count_product_in_cart(cart_items: dict, product_id: str) -> int:
+    return sum(
         [
             product["quantity"]
             for product in cart_items["data"]
@@ -70,24 +109,80 @@ def get_product_in_cart_count(elastic_token: str, product_id: str, cart_id: str)
         ]
     )
 
-    return product_in_cart_count
+
+def get_main_image_id(product: dict) -> str:
+    return product["data"]["relationships"]["main_image"]["data"]["id"]
+
+
+async def as_awaitable(value):
+    return value
+
+
+async def fetch_description_details(
+    elastic_token: str,
+    product_id: str,
+    cart_id: str,
+    product: Optional[dict] = None,
+    cart_items: Optional[dict] = None,
+    picture_href: Optional[str] = None,
+) -> tuple[dict, dict, str]:
+    # only what is missing from the caches is requested
+    product, cart_items = await asyncio.gather(
+        async_elastic_api.get_product(
+            credential_token=elastic_token, product_id=product_id
+        )
+        if product is None
+        else as_awaitable(product),
+        async_elastic_api.get_cart_items(
+            credential_token=elastic_token, cart_id=cart_id
+        )
+        if cart_items is None
+        else as_awaitable(cart_items),
+    )
+
+    if picture_href is None:
+        picture_href = await async_elastic_api.get_file_href(
+            credential_token=elastic_token, file_id=get_main_image_id(product)
+        )
+
+    return product, cart_items, picture_href
 
 
 def get_description_markup(
-    elastic_token: str, product_id: str, user_id: str
+    product_cache: ProductCache,
+    cart_mirror: CartMirror,
+    elastic_token: str,
+    product_id: str,
+    user_id: str,
 ) -> tuple[str, str, InlineKeyboardMarkup]:
+    cached_product = product_cache.get_product(product_id)
+    cached_cart_items = cart_mirror.get_cached_cart_items(user_id)
+    cached_picture_href = None
+    if cached_product:
+        cached_picture_href = product_cache.get_file_href(
+            get_main_image_id(cached_product)
+        )
 
-    product = elastic_api.get_product(
-        credential_token=elastic_token, product_id=product_id
-    )
-    product_details = product["data"]
-    product_in_cart_count = get_product_in_cart_count(
-        elastic_token=elastic_token, product_id=product_id, cart_id=user_id
+    product, cart_items, picture_href = async_elastic_api.run(
+        fetch_description_details(
+            elastic_token=elastic_token,
+            product_id=product_id,
+            cart_id=user_id,
+            product=cached_product,
+            cart_items=cached_cart_items,
+            picture_href=cached_picture_href,
+        )
     )
+    if cached_product is None:
+        product_cache.set_product(product_id, product)
+    if cached_cart_items is None:
+        cart_mirror.store(user_id, cart_items)
+    if cached_picture_href is None:
+        product_cache.set_file_href(get_main_image_id(product), picture_href)
 
-    picture_href = elastic_api.get_file_href(
-        credential_token=elastic_token,
-        file_id=product["data"]["relationships"]["main_image"]["data"]["id"],
+    product_details = product["data"]
+    product_in_cart_count = count_product_in_cart(
+        cart_items=cart_items, product_id=product_id
     )
 
     product_description = f"""
@@ -108,20 +203,19 @@ def get_description_markup(
     return picture_href, product_description, description_markup
 
 
+def get_cart_total_price(cart_items: dict) -> int:
+    return sum(product["value"]["amount"] for product in cart_items["data"])
+
+
 def get_cart_markup(
-    elastic_token: str, cart_id: str
+    cart_mirror: CartMirror, elastic_token: str, cart_id: str
 ) -> tuple[str, InlineKeyboardMarkup]:
-    cart_items = elastic_api.get_cart_items(
-        credential_token=elastic_token,
-        cart_id=cart_id,
-    )
+    cart_items = cart_mirror.get_cart_items(elastic_token=elastic_token, cart_id=cart_id)
 
-    total_price = 0
+    total_price = get_cart_total_price(cart_items)
     cart_summary_lines = []
 
     for product in cart_items["data"]:
-        total_price += product["value"]["amount"]
-
         product_summary_text = dedent(
             f"""
         Название: {product["name"]}
@@ -163,23 +257,25 @@ def get_location_markup(user_first_name: str) -> tuple[str, InlineKeyboardMarkup
 
 
 def get_delivery_markup(
-    elastic_token: str, user_coordinates: tuple[str, str], user_id: str
+    pizzeria_index: geocode.PizzeriaIndex,
+    coordinates_writer: CoordinatesWriter,
+    elastic_token: str,
+    user_coordinates: tuple[str, str],
+    user_id: str,
 ) -> tuple[dict, str, InlineKeyboardMarkup]:
     longitude, latitude = user_coordinates
-    elastic_api.create_coordinates_entry(
-        credential_token=elastic_token,
-        coordinates_slug="coordinates",
-        telegram_id=user_id,
-        longitude=longitude,
-        latitude=latitude,
+    coordinates_writer.enqueue(
+        telegram_id=user_id, longitude=longitude, latitude=latitude
     )
 
-    all_pizzerias = elastic_api.get_all_entries(
-        credential_token=elastic_token, slug="pizzeria"
-    )
-    nearest_pizzeria = geocode.get_nearest_pizzeria(
-        user_coordinates=user_coordinates, pizzerias=all_pizzerias["data"]
-    )
+    # the index is kept fresh by a periodic job, Moltin is only asked
+    # when nothing has been loaded yet
+    if not len(pizzeria_index):
+        all_pizzerias = elastic_api.get_all_entries(
+            credential_token=elastic_token, slug="pizzeria"
+        )
+        pizzeria_index.sync(all_pizzerias["data"])
+    nearest_pizzeria, *_ = pizzeria_index.nearest(user_coordinates=user_coordinates)
 
     if nearest_pizzeria["distance"] <= 0.5:
         delivery_description = "Предлагаем забрать пиццу самостоятельно или воспользоваться бесплатной доставкой."
@@ -0,0 +1,84 @@
+import hashlib
+import logging
+from io import BytesIO
+from typing import Optional, Union
+
+import redis
+import requests
+from PIL import Image, UnidentifiedImageError
+from telegram import Message
+
+import metrics
+
+
+logger = logging.getLogger(__file__)
+
+PHOTO_MAX_SIDE = 1280  # pixels, Telegram shows nothing larger in a chat
+PHOTO_JPEG_QUALITY = 85
+DOWNLOAD_TIMEOUT = (3.05, 15)  # connect, read seconds
+TELEGRAM_FILE_TTL = 90 * 24 * 60 * 60  # seconds
+
+
+def get_image_version(picture_href: str) -> str:
+    # a replaced image gets a new href, so the old file_id is never reused
+    return hashlib.sha1(picture_href.encode()).hexdigest()[:16]
+
+
+def prepare_photo(
+    picture_href: str,
+    max_side: int = PHOTO_MAX_SIDE,
+    quality: int = PHOTO_JPEG_QUALITY,
+) -> BytesIO:
+    with metrics.track_api_call("moltin_cdn", "GET file"):
+        response = requests.get(picture_href, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+
+    image = Image.open(BytesIO(response.content))
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    photo = BytesIO()
+    image.convert("RGB").save(
+        photo, format="JPEG", quality=quality, optimize=True, progressive=True
+    )
+    photo.seek(0)
+    photo.name = "photo.jpg"
+
+    return photo
+
+
+class MediaCache:
+    # every product image is downloaded, shrunk and uploaded to Telegram
+    # once, later views send the file_id Telegram returned for the upload
+    def __init__(self, redis_connection: redis.Redis, ttl: int = TELEGRAM_FILE_TTL):
+        self.redis = redis_connection
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(product_id: str, picture_href: str) -> str:
+        return f"telegram_file:{product_id}:{get_image_version(picture_href)}"
+
+    def get_file_id(self, product_id: str, picture_href: str) -> Optional[str]:
+        file_id = self.redis.get(self._key(product_id, picture_href))
+        metrics.record_cache_lookup("telegram_file", hit=file_id is not None)
+        return file_id.decode() if file_id else None
+
+    def get_photo(
+        self, product_id: str, picture_href: str
+    ) -> tuple[Union[str, BytesIO], bool]:
+        # returns what to pass to send_photo and whether it is a cached file_id
+        file_id = self.get_file_id(product_id, picture_href)
+        if file_id:
+            return file_id, True
+
+        try:
+            return prepare_photo(picture_href), False
+        except (requests.RequestException, UnidentifiedImageError, OSError):
+            # Telegram can still fetch the original by its URL
+            logger.exception(f"Couldn't prepare the photo of product {product_id}")
+            return picture_href, False
+
+    def remember(self, product_id: str, picture_href: str, message: Message):
+        file_id = message.photo[-1].file_id
+        self.redis.set(self._key(product_id, picture_href), file_id, ex=self.ttl)
+
+    def forget(self, product_id: str, picture_href: str):
+        self.redis.delete(self._key(product_id, picture_href))
@@ -0,0 +1,120 @@
+import re
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterator
+
+from prometheus_client import Counter, Histogram, start_http_server
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from telegram.error import TelegramError
+from telegram.utils.request import Request
+
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_seconds", "Time spent in a Telegram handler", ["handler"]
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Handlers that raised an exception", ["handler"]
+)
+API_LATENCY = Histogram(
+    "bot_api_request_seconds", "Outbound API call latency", ["service", "endpoint"]
+)
+API_REQUESTS = Counter(
+    "bot_api_requests_total",
+    "Outbound API calls by response status",
+    ["service", "endpoint", "status"],
+)
+CACHE_REQUESTS = Counter(
+    "bot_cache_requests_total", "Cache lookups by result", ["cache", "result"]
+)
+DELAYED_JOB_LAG = Histogram(
+    "bot_delayed_job_lag_seconds",
+    "Time between a delayed job being due and firing",
+    ["job"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float("inf")),
+)
+
+ID_SEGMENT = re.compile(r"/(?=[^/]*\d)[\w-]{4,}(?=/|$)")
+
+
+def get_endpoint(path: str) -> str:
+    # ids in the path would blow up the number of label values
+    return ID_SEGMENT.sub("/{id}", path)
+
+
+def record_api_call(service: str, endpoint: str, status: str, seconds: float):
+    API_LATENCY.labels(service, endpoint).observe(seconds)
+    API_REQUESTS.labels(service, endpoint, status).inc()
+
+
+@contextmanager
+def track_api_call(service: str, endpoint: str) -> Iterator:
+    started_at = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    except TelegramError as error:
+        status = type(error).__name__
+        raise
+    finally:
+        record_api_call(service, endpoint, status, time.perf_counter() - started_at)
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def record_delayed_job_lag(job: str, seconds: float):
+    DELAYED_JOB_LAG.labels(job).observe(max(0.0, seconds))
+
+
+def track_handler(handler: Callable) -> Callable:
+    latency = HANDLER_LATENCY.labels(handler.__name__)
+    errors = HANDLER_ERRORS.labels(handler.__name__)
+
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started_at)
+
+    return wrapper
+
+
+class InstrumentedRequest(Request):
+    def post(self, url: str, data: dict, timeout: float = None):
+        with track_api_call("telegram", url.rsplit("/", 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+    def retrieve(self, url: str, timeout: float = None) -> bytes:
+        with track_api_call("telegram", "file"):
+            return super().retrieve(url, timeout=timeout)
+
+
+class CallbackCollector:
+    # gauges computed only when Prometheus scrapes, nothing on the hot path
+    def __init__(self, name: str, documentation: str, labels: list, callback):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.callback = callback
+
+    def collect(self):
+        gauge = GaugeMetricFamily(self.name, self.documentation, labels=self.labels)
+        for label_values, value in self.callback():
+            gauge.add_metric(label_values, value)
+        yield gauge
+
+
+def register_gauge(name: str, documentation: str, labels: list, callback):
+    REGISTRY.register(CallbackCollector(name, documentation, labels, callback))
+
+
+def start_metrics_server(port: int, address: str = "127.0.0.1"):
+    start_http_server(port, addr=address)
@@ -0,0 +1,227 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from enum import IntEnum
+from itertools import count
+from typing import Optional
+
+from cachetools import TTLCache
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from workers import OrderedWorkerPool
+
+
+logger = logging.getLogger(__file__)
+
+# Telegram allows about 30 messages a second overall and one a second per chat
+GLOBAL_RATE = 30  # messages per second
+CHAT_RATE = 1  # messages per second
+CHAT_BURST = 3
+CHAT_BUCKETS_SIZE = 10000
+CHAT_BUCKETS_TTL = 10 * 60  # seconds
+OUTBOX_WORKERS = 4
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 1  # seconds, multiplied by the attempt number
+
+
+class Priority(IntEnum):
+    PAYMENT = 0
+    COURIER = 1
+    MARKETING = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def get_wait(self, now: float) -> float:
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+
+
+class OutboundMessage:
+    def __init__(
+        self, method: str, chat_id: int, priority: Priority, kwargs: dict, sequence: int
+    ):
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.kwargs = kwargs
+        self.sequence = sequence
+        self.attempts = 0
+        # resolved with Telegram's answer or the error the message was dropped on
+        self.delivered = Future()
+
+
+class Outbox:
+    # handlers only enqueue; a scheduler thread releases messages by priority
+    # within the global and per chat flood limits, and an ordered pool sends
+    # them so messages to one chat keep their order
+    def __init__(
+        self,
+        bot: Bot,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: float = CHAT_BURST,
+        workers: int = OUTBOX_WORKERS,
+    ):
+        self.bot = bot
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = TTLCache(maxsize=CHAT_BUCKETS_SIZE, ttl=CHAT_BUCKETS_TTL)
+        self.pool = OrderedWorkerPool(workers=workers, name="outbox")
+        self._ready = []  # (priority, sequence, message)
+        self._delayed = []  # (ready_at, priority, sequence, message)
+        self._sequence = count()
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def send(self, method: str, chat_id: int, priority: Priority, **kwargs) -> Future:
+        message = OutboundMessage(
+            method, chat_id, priority, kwargs, sequence=next(self._sequence)
+        )
+        self._push(message)
+        return message.delivered
+
+    def _push(self, message: OutboundMessage, ready_at: Optional[float] = None):
+        with self._condition:
+            if ready_at is None:
+                heapq.heappush(
+                    self._ready, (message.priority, message.sequence, message)
+                )
+            else:
+                heapq.heappush(
+                    self._delayed,
+                    (ready_at, message.priority, message.sequence, message),
+                )
+            self._condition.notify()
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        chat_bucket = self.chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            chat_bucket = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst)
+            self.chat_buckets[chat_id] = chat_bucket
+        return chat_bucket
+
+    def _release(self) -> tuple[list, Optional[float]]:
+        # called under the condition lock, returns the messages to send now
+        # and how long to sleep before anything else can go
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, priority, sequence, message = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (priority, sequence, message))
+
+        released = []
+        while self._ready:
+            global_wait = self.global_bucket.get_wait(now)
+            if global_wait:
+                return released, global_wait
+
+            _, _, message = heapq.heappop(self._ready)
+            chat_bucket = self._get_chat_bucket(message.chat_id)
+            chat_wait = chat_bucket.get_wait(now)
+            if chat_wait:
+                heapq.heappush(
+                    self._delayed,
+                    (now + chat_wait, message.priority, message.sequence, message),
+                )
+                continue
+
+            chat_bucket.consume(now)
+            self.global_bucket.consume(now)
+            released.append(message)
+
+        wait = self._delayed[0][0] - now if self._delayed else None
+        return released, wait
+
+    def _deliver(self, message: OutboundMessage):
+        with self._condition:
+            blocked_until = self._get_chat_bucket(message.chat_id).blocked_until
+        # the chat got a retry after while this message was already released
+        if blocked_until > time.monotonic():
+            self._push(message, ready_at=blocked_until)
+            return
+
+        try:
+            result = getattr(self.bot, message.method)(
+                chat_id=message.chat_id, **message.kwargs
+            )
+        except RetryAfter as error:
+            ready_at = time.monotonic() + error.retry_after
+            with self._condition:
+                self._get_chat_bucket(message.chat_id).block(ready_at)
+            self._push(message, ready_at=ready_at)
+        except TelegramError as error:
+            message.attempts += 1
+            # a bad request fails the same way on every attempt
+            is_transient = isinstance(error, NetworkError) and not isinstance(
+                error, BadRequest
+            )
+            if not is_transient or message.attempts >= MAX_ATTEMPTS:
+                logger.exception(
+                    f"Dropping {message.method} to chat {message.chat_id}"
+                )
+                message.delivered.set_exception(error)
+                return
+            self._push(
+                message, ready_at=time.monotonic() + RETRY_DELAY * message.attempts
+            )
+        except Exception as error:
+            message.delivered.set_exception(error)
+            raise
+        else:
+            message.delivered.set_result(result)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                released, wait = self._release()
+                if not released:
+                    self._condition.wait(timeout=wait)
+                    continue
+
+            for message in released:
+                self.pool.submit(message.chat_id, self._deliver, message)
+
+    def get_depth(self) -> list:
+        with self._condition:
+            depth = {priority: 0 for priority in Priority}
+            for *_, message in self._ready + self._delayed:
+                depth[message.priority] += 1
+        return [([priority.name.lower()], size) for priority, size in depth.items()]
+
+    def start(self):
+        threading.Thread(target=self._run, name="outbox", daemon=True).start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.pool.stop()
@@ -0,0 +1,223 @@
+import logging
+import pickle
+import threading
+from collections import defaultdict
+from typing import Optional
+
+import redis
+from telegram.ext import BasePersistence
+from telegram.ext.utils.types import ConversationDict
+
+
+logger = logging.getLogger(__file__)
+
+FLUSH_INTERVAL = 1  # seconds
+
+
+class RedisPersistence(BasePersistence):
+    # updates only mark entries dirty, a background thread writes the
+    # changed ones to Redis in one pipeline every FLUSH_INTERVAL seconds;
+    # bot_data holds connections, caches and secrets that run_bot rebuilds
+    # on startup, so it is never stored
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        prefix: str = "persistence",
+        flush_interval: float = FLUSH_INTERVAL,
+    ):
+        super().__init__(
+            store_user_data=True, store_chat_data=True, store_bot_data=False
+        )
+        self.redis = redis_connection
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.user_data = None
+        self.chat_data = None
+        self.bot_data = None
+        self.conversations = {}
+        self._written = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._flusher = None
+
+    # nothing stored here references the Bot, so skip walking every object
+    # after each update to swap it out
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        return obj
+
+    def insert_bot(self, obj: object) -> object:
+        return obj
+
+    def _key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    def _mark_dirty(self, key: str, field: str, value: object):
+        # None marks a field to be deleted from the hash
+        serialized = None
+        if value is not None:
+            serialized = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._written.get((key, field)) == serialized:
+                self._dirty.pop((key, field), None)
+                return
+            self._dirty[(key, field)] = serialized
+        self._start_flusher()
+
+    def _load_hash(self, key: str) -> dict:
+        loaded = {}
+        for field, serialized in self.redis.hgetall(key).items():
+            field = field.decode()
+            self._written[(key, field)] = serialized
+            loaded[field] = pickle.loads(serialized)
+
+        return loaded
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, daemon=True
+            )
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except redis.RedisError:
+                logger.exception("Failed to flush persistence to Redis")
+
+    def get_user_data(self) -> defaultdict:
+        if self.user_data is None:
+            self.user_data = defaultdict(dict)
+            user_data = self._load_hash(self._key("user_data"))
+            for user_id, data in user_data.items():
+                self.user_data[int(user_id)] = data
+
+        return self.user_data
+
+    def get_chat_data(self) -> defaultdict:
+        if self.chat_data is None:
+            self.chat_data = defaultdict(dict)
+            chat_data = self._load_hash(self._key("chat_data"))
+            for chat_id, data in chat_data.items():
+                self.chat_data[int(chat_id)] = data
+
+        return self.chat_data
+
+    def get_bot_data(self) -> dict:
+        if self.bot_data is None:
+            self.bot_data = {}
+
+        return self.bot_data
+
+    def get_conversations(self, name: str) -> ConversationDict:
+        if name not in self.conversations:
+            conversations = self._load_hash(self._key(f"conversations:{name}"))
+            self.conversations[name] = {
+                tuple(int(part) for part in key.split(":")): state
+                for key, state in conversations.items()
+            }
+
+        return self.conversations[name]
+
+    def update_conversation(
+        self, name: str, key: tuple[int, ...], new_state: Optional[object]
+    ):
+        conversations = self.conversations.setdefault(name, {})
+        if conversations.get(key) == new_state:
+            return
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._mark_dirty(
+            self._key(f"conversations:{name}"), ":".join(map(str, key)), new_state
+        )
+
+    def update_user_data(self, user_id: int, data: dict):
+        self.get_user_data()[user_id] = data
+        self._mark_dirty(self._key("user_data"), str(user_id), data)
+
+    def update_chat_data(self, chat_id: int, data: dict):
+        self.get_chat_data()[chat_id] = data
+        self._mark_dirty(self._key("chat_data"), str(chat_id), data)
+
+    def update_bot_data(self, data: dict):
+        self.bot_data = data
+
+    def reload(self, user_id: Optional[int], chat_id: Optional[int]):
+        # another process may have handled this user since the hashes were
+        # loaded; conversations are keyed by (chat_id, user_id), the
+        # ConversationHandler default
+        entries = []
+        if user_id is not None:
+            entries.append((self._key("user_data"), str(user_id)))
+        if chat_id is not None:
+            entries.append((self._key("chat_data"), str(chat_id)))
+        if user_id is not None and chat_id is not None:
+            entries.extend(
+                (self._key(f"conversations:{name}"), f"{chat_id}:{user_id}")
+                for name in self.conversations
+            )
+
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, field in entries:
+            pipeline.hget(key, field)
+        serialized_values = pipeline.execute()
+
+        with self._lock:
+            # changes not flushed yet are newer than anything in Redis
+            loaded = [
+                (key, field, serialized)
+                for (key, field), serialized in zip(entries, serialized_values)
+                if (key, field) not in self._dirty
+            ]
+            for key, field, serialized in loaded:
+                self._written[(key, field)] = serialized
+
+        for key, field, serialized in loaded:
+            value = pickle.loads(serialized) if serialized is not None else None
+            if key == self._key("user_data"):
+                entries_in_memory, entry_key = self.get_user_data(), int(field)
+            elif key == self._key("chat_data"):
+                entries_in_memory, entry_key = self.get_chat_data(), int(field)
+            else:
+                name = key[len(self._key("conversations:")):]
+                entries_in_memory = self.conversations[name]
+                entry_key = tuple(int(part) for part in field.split(":"))
+
+            if value is None:
+                entries_in_memory.pop(entry_key, None)
+            else:
+                entries_in_memory[entry_key] = value
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+
+        pipeline = self.redis.pipeline(transaction=False)
+        for (key, field), serialized in dirty.items():
+            if serialized is None:
+                pipeline.hdel(key, field)
+            else:
+                pipeline.hset(key, field, serialized)
+        try:
+            pipeline.execute()
+        except redis.RedisError:
+            # put the entries back unless they were changed in the meantime
+            with self._lock:
+                self._dirty = {**dirty, **self._dirty}
+            raise
+
+        with self._lock:
+            self._written.update(dirty)
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
@@ -0,0 +1,84 @@
+import json
+import threading
+from typing import Optional
+
+import redis
+from cachetools import TTLCache
+
+import metrics
+
+
+PRODUCT_CACHE_SIZE = 512
+PRODUCT_CACHE_TTL = 600  # seconds
+
+
+class ProductCache:
+    # two tiers: an in-process LRU with TTL in front of Redis,
+    # so every bot process shares entries warmed by the others
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        maxsize: int = PRODUCT_CACHE_SIZE,
+        ttl: int = PRODUCT_CACHE_TTL,
+    ):
+        self.redis = redis_connection
+        self.ttl = ttl
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[object]:
+        cache_name, _ = key.split(":", 1)
+        with self._lock:
+            value = self._local.get(key)
+        if value is not None:
+            metrics.record_cache_lookup(cache_name, hit=True)
+            return value
+
+        raw_value = self.redis.get(key)
+        metrics.record_cache_lookup(cache_name, hit=raw_value is not None)
+        if raw_value is None:
+            return None
+        value = json.loads(raw_value)
+        with self._lock:
+            self._local[key] = value
+
+        return value
+
+    def _set(self, key: str, value: object):
+        with self._lock:
+            self._local[key] = value
+        self.redis.set(key, json.dumps(value, ensure_ascii=False), ex=self.ttl)
+
+    def _warm(self, key: str, value: object):
+        # in-process only, Redis may already hold newer entries
+        with self._lock:
+            self._local[key] = value
+
+    def get_product(self, product_id: str) -> Optional[dict]:
+        return self._get(f"product:{product_id}")
+
+    def set_product(self, product_id: str, product: dict):
+        self._set(f"product:{product_id}", product)
+
+    def warm_product(self, product_id: str, product: dict):
+        self._warm(f"product:{product_id}", product)
+
+    def get_file_href(self, file_id: str) -> Optional[str]:
+        return self._get(f"file_href:{file_id}")
+
+    def set_file_href(self, file_id: str, file_href: str):
+        self._set(f"file_href:{file_id}", file_href)
+
+    def warm_file_href(self, file_id: str, file_href: str):
+        self._warm(f"file_href:{file_id}", file_href)
+
+    def _invalidate(self, key: str):
+        with self._lock:
+            self._local.pop(key, None)
+        self.redis.delete(key)
+
+    def invalidate_product(self, product_id: str):
+        self._invalidate(f"product:{product_id}")
+
+    def invalidate_file_href(self, file_id: str):
+        self._invalidate(f"file_href:{file_id}")
@@ -0,0 +1,199 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import requests
+from cachetools import LRUCache
+
+
+logger = logging.getLogger(__file__)
+
+FAILURE_RATE_THRESHOLD = 0.5
+MINIMUM_CALLS = 10
+FAILURE_WINDOW = 30  # seconds
+OPEN_TIMEOUT = 30  # seconds
+DEFAULT_RETRY_AFTER = 1  # seconds, for a 429 without Retry-After
+MAX_RATE_LIMIT_WAIT = 5  # seconds
+STALE_RESPONSES_SIZE = 1024
+BREAKER_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+# subclasses of ConnectionError, so code that already copes with Moltin or
+# Yandex being unreachable copes with a tripped breaker the same way
+class ServiceUnavailableError(requests.ConnectionError):
+    pass
+
+
+class CircuitOpenError(ServiceUnavailableError):
+    pass
+
+
+class RateLimitedError(ServiceUnavailableError):
+    pass
+
+
+def get_retry_after(headers: dict) -> float:
+    try:
+        return float(headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+class CircuitBreaker:
+    # closed: calls go through and their outcomes are kept for a sliding
+    # window; open: calls fail at once; half open: a single trial call
+    # decides whether to close again
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = FAILURE_RATE_THRESHOLD,
+        minimum_calls: int = MINIMUM_CALLS,
+        window: float = FAILURE_WINDOW,
+        open_timeout: float = OPEN_TIMEOUT,
+    ):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.open_timeout = open_timeout
+        self.outcomes = deque()
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.open_timeout:
+            return "open"
+        return "half_open"
+
+    def before_call(self) -> bool:
+        # returns whether the call is the half open trial
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+        raise CircuitOpenError(f"Circuit {self.name} is open")
+
+    def release_trial(self):
+        # a trial that ended without an outcome, raised or was cancelled,
+        # lets the next call try again instead of keeping the breaker open
+        with self._lock:
+            self._trial_running = False
+
+    def record(self, is_failure: bool, is_trial: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            if is_trial:
+                self._trial_running = False
+                if is_failure:
+                    self.opened_at = now
+                else:
+                    self.opened_at = None
+                    self.outcomes.clear()
+                    logger.info(f"Circuit {self.name} closed")
+                return
+            # late answers of calls made before the breaker opened
+            if self.opened_at is not None:
+                return
+
+            self.outcomes.append((now, is_failure))
+            while self.outcomes[0][0] < now - self.window:
+                self.outcomes.popleft()
+            failures = sum(failure for _, failure in self.outcomes)
+            if (
+                len(self.outcomes) >= self.minimum_calls
+                and failures / len(self.outcomes) >= self.failure_rate_threshold
+            ):
+                self.opened_at = now
+                logger.warning(
+                    f"Circuit {self.name} opened, {failures} of "
+                    f"{len(self.outcomes)} calls failed"
+                )
+
+
+class RateLimiter:
+    # once a service answers 429 every caller waits until its Retry-After
+    # has passed instead of hammering it further
+    def __init__(self, name: str, max_wait: float = MAX_RATE_LIMIT_WAIT):
+        self.name = name
+        self.max_wait = max_wait
+        self.blocked_until = 0.0
+
+    def get_delay(self) -> float:
+        delay = max(0.0, self.blocked_until - time.monotonic())
+        if delay > self.max_wait:
+            raise RateLimitedError(f"{self.name} asked to retry in {delay:.0f}s")
+        return delay
+
+    def block(self, retry_after: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+
+class ServiceGuard:
+    # a breaker per endpoint, a rate limiter per service and the last good
+    # answers of read endpoints to fall back on
+    def __init__(
+        self, service: str, stale_responses_size: int = STALE_RESPONSES_SIZE
+    ):
+        self.service = service
+        self.rate_limiter = RateLimiter(service)
+        self.breakers = {}
+        self._stale_responses = LRUCache(maxsize=stale_responses_size)
+        self._lock = threading.Lock()
+
+    def get_breaker(self, endpoint: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is None:
+                breaker = CircuitBreaker(f"{self.service} {endpoint}")
+                self.breakers[endpoint] = breaker
+            return breaker
+
+    def admit(self, endpoint: str) -> tuple[bool, float]:
+        # raises when the call must not be made, otherwise returns whether
+        # it is a breaker trial and how long to wait before making it
+        delay = self.rate_limiter.get_delay()
+        return self.get_breaker(endpoint).before_call(), delay
+
+    def record(
+        self,
+        endpoint: str,
+        is_trial: bool,
+        status_code: Optional[int],
+        headers: Optional[dict] = None,
+    ) -> bool:
+        # status_code is None when the call didn't get an answer at all
+        if status_code == 429:
+            self.rate_limiter.block(get_retry_after(headers or {}))
+        is_failure = status_code is None or status_code == 429 or status_code >= 500
+        self.get_breaker(endpoint).record(is_failure, is_trial=is_trial)
+        return is_failure
+
+    def release(self, endpoint: str, is_trial: bool):
+        # called in a finally after every admitted call, recorded or not
+        if is_trial:
+            self.get_breaker(endpoint).release_trial()
+
+    def store_stale(self, key: str, body: bytes):
+        with self._lock:
+            self._stale_responses[key] = body
+
+    def get_stale(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._stale_responses.get(key)
+
+    def get_states(self) -> list:
+        with self._lock:
+            breakers = list(self.breakers.items())
+        return [
+            ([self.service, endpoint], BREAKER_STATE_VALUES[breaker.state])
+            for endpoint, breaker in breakers
+        ]
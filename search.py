@@ -0,0 +1,135 @@
+import re
+import threading
+from collections import defaultdict
+from typing import Optional
+
+
+SEARCH_RESULTS_LIMIT = 10
+NAME_WEIGHT = 3
+DESCRIPTION_WEIGHT = 1
+
+
+def tokenize(text: str) -> list[str]:
+    # casefold covers Cyrillic, and hardly anybody types ё
+    return re.findall(r"\w+", text.casefold().replace("ё", "е"))
+
+
+class TrieNode:
+    def __init__(self):
+        self.children = {}
+        self.tokens = set()
+
+
+class ProductSearchIndex:
+    # a prefix trie over tokens finds the word being typed, an inverted
+    # index maps whole tokens to products; both live in memory, so a query
+    # never reaches Moltin
+    def __init__(self, products: list[dict] = ()):
+        self.catalog_version = None
+        self._products = {}
+        self._product_tokens = {}
+        self._postings = defaultdict(dict)
+        self._trie = TrieNode()
+        self._lock = threading.Lock()
+        self.sync(products)
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    @staticmethod
+    def _get_token_weights(product: dict) -> dict:
+        token_weights = {}
+        for token in tokenize(product.get("description", "")):
+            token_weights[token] = DESCRIPTION_WEIGHT
+        for token in tokenize(product["name"]):
+            token_weights[token] = NAME_WEIGHT
+        return token_weights
+
+    def _add(self, product: dict):
+        token_weights = self._get_token_weights(product)
+        self._products[product["id"]] = product
+        self._product_tokens[product["id"]] = token_weights
+        for token, weight in token_weights.items():
+            if not self._postings[token]:
+                node = self._trie
+                for letter in token:
+                    node = node.children.setdefault(letter, TrieNode())
+                    node.tokens.add(token)
+            self._postings[token][product["id"]] = weight
+
+    def _remove(self, product_id: str):
+        del self._products[product_id]
+        for token in self._product_tokens.pop(product_id):
+            postings = self._postings[token]
+            del postings[product_id]
+            if postings:
+                continue
+
+            del self._postings[token]
+            node = self._trie
+            for letter in token:
+                child = node.children[letter]
+                child.tokens.discard(token)
+                if not child.tokens:
+                    del node.children[letter]
+                    break
+                node = child
+
+    def sync(self, products: list[dict], catalog_version: Optional[int] = None):
+        # only products that were added, changed or removed are reindexed
+        products = {product["id"]: product for product in products}
+        with self._lock:
+            for product_id in list(self._products):
+                if products.get(product_id) != self._products[product_id]:
+                    self._remove(product_id)
+            for product_id, product in products.items():
+                if product_id not in self._products:
+                    self._add(product)
+            self.catalog_version = catalog_version
+
+    def _match_prefix(self, prefix: str) -> dict:
+        node = self._trie
+        for letter in prefix:
+            node = node.children.get(letter)
+            if node is None:
+                return {}
+
+        matches = {}
+        for token in node.tokens:
+            for product_id, weight in self._postings[token].items():
+                matches[product_id] = max(matches.get(product_id, 0), weight)
+        return matches
+
+    def search(self, query: str, limit: int = SEARCH_RESULTS_LIMIT) -> list[dict]:
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            scores = None
+            for position, token in enumerate(tokens):
+                # the last word may still be being typed
+                if position == len(tokens) - 1:
+                    matches = self._match_prefix(token)
+                else:
+                    matches = self._postings.get(token, {})
+
+                if scores is None:
+                    scores = dict(matches)
+                else:
+                    scores = {
+                        product_id: score + matches[product_id]
+                        for product_id, score in scores.items()
+                        if product_id in matches
+                    }
+                if not scores:
+                    return []
+
+            ranked_ids = sorted(
+                scores,
+                key=lambda product_id: (
+                    -scores[product_id],
+                    self._products[product_id]["name"],
+                ),
+            )
+            return [self._products[product_id] for product_id in ranked_ids[:limit]]
@@ -0,0 +1,315 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Hashable, Optional
+
+import redis
+from cachetools import LRUCache
+from telegram import Update
+from telegram.ext import Updater
+
+from persistence import RedisPersistence
+from workers import get_update_key
+
+
+logger = logging.getLogger(__file__)
+
+WORKERS_KEY = "shard:workers"
+RING_REPLICAS = 100
+HEARTBEAT_INTERVAL = 2  # seconds
+WORKER_TIMEOUT = 10  # seconds without a heartbeat
+ROUTES_SIZE = 100_000
+DISPATCHER_BACKLOG = 100
+
+
+class NoShardWorkersError(Exception):
+    pass
+
+
+def get_queue_key(worker_id: str) -> str:
+    return f"shard:{worker_id}:updates"
+
+
+def get_processed_key(worker_id: str) -> str:
+    return f"shard:{worker_id}:processed"
+
+
+def get_shard_key(update: Update) -> Hashable:
+    key = get_update_key(update)
+    return update.update_id if key is None else key
+
+
+def get_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    # every worker takes many points on the ring, so adding or removing one
+    # moves only its own share of users instead of reshuffling everybody
+    def __init__(self, nodes: list[str] = (), replicas: int = RING_REPLICAS):
+        self.replicas = replicas
+        self.nodes = frozenset(nodes)
+        self._points = sorted(
+            (get_hash(f"{node}:{replica}"), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [point_hash for point_hash, _ in self._points]
+
+    def get_node(self, key: Hashable) -> Optional[str]:
+        if not self._points:
+            return None
+        index = bisect.bisect(self._hashes, get_hash(str(key))) % len(self._points)
+        return self._points[index][1]
+
+
+class ShardRouter:
+    # runs at the ingestion point and pushes every update to the Redis queue
+    # of the worker owning its user; a user stays with its worker until the
+    # worker confirms it has handled the last update routed to it, so a
+    # rebalance never splits one user's updates across processes
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        replicas: int = RING_REPLICAS,
+        worker_timeout: float = WORKER_TIMEOUT,
+    ):
+        self.redis = redis_connection
+        self.replicas = replicas
+        self.worker_timeout = worker_timeout
+        self.ring = HashRing(replicas=replicas)
+        # key -> (worker_id, id of the last update pushed to it)
+        self.routes = LRUCache(maxsize=ROUTES_SIZE)
+        self._refreshed_at = 0.0
+        self._lock = threading.RLock()
+
+    def refresh_workers(self):
+        now = time.time()
+        workers = {
+            worker_id.decode(): last_seen
+            for worker_id, last_seen in self.redis.zrange(
+                WORKERS_KEY, 0, -1, withscores=True
+            )
+        }
+        alive = {
+            worker_id
+            for worker_id, last_seen in workers.items()
+            if now - last_seen <= self.worker_timeout
+        }
+        with self._lock:
+            self._refreshed_at = time.monotonic()
+            if alive != self.ring.nodes:
+                self.ring = HashRing(alive, replicas=self.replicas)
+                logger.info(f"Shard ring rebalanced over {len(alive)} workers")
+            if not alive:
+                # updates of gone workers wait for somebody to take them
+                return
+
+            for worker_id in set(workers) - alive:
+                self.redis.zrem(WORKERS_KEY, worker_id)
+                self._requeue(worker_id)
+
+    def _requeue(self, worker_id: str):
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.lrange(get_queue_key(worker_id), 0, -1)
+        pipeline.delete(get_queue_key(worker_id), get_processed_key(worker_id))
+        orphaned_updates, _ = pipeline.execute()
+
+        for key, (routed_to, _) in list(self.routes.items()):
+            if routed_to == worker_id:
+                del self.routes[key]
+        # the queue is pushed on the left, so the oldest update is last
+        for update_json in reversed(orphaned_updates):
+            update_details = json.loads(update_json)
+            self._push(update_details["key"], update_details["update"])
+        logger.info(
+            f"Moved {len(orphaned_updates)} updates of gone worker {worker_id}"
+        )
+
+    def _is_processed(self, worker_id: str, key: Hashable, update_id: int) -> bool:
+        processed_update_id = self.redis.hget(get_processed_key(worker_id), str(key))
+        return processed_update_id is not None and int(processed_update_id) == update_id
+
+    def _push(self, key: Hashable, update_details: dict):
+        worker_id = self.ring.get_node(key)
+        if worker_id is None:
+            raise NoShardWorkersError("No shard worker is alive")
+
+        route = self.routes.get(key)
+        if route:
+            routed_to, last_update_id = route
+            if (
+                routed_to != worker_id
+                and routed_to in self.ring.nodes
+                and not self._is_processed(routed_to, key, last_update_id)
+            ):
+                worker_id = routed_to
+        # the new owner has to load the user's state left by the previous one
+        is_moved = route is None or route[0] != worker_id
+
+        self.routes[key] = (worker_id, update_details["update_id"])
+        update_json = json.dumps(
+            {"key": key, "is_moved": is_moved, "update": update_details}
+        )
+        self.redis.lpush(get_queue_key(worker_id), update_json)
+
+    def route(self, update: Update):
+        if time.monotonic() - self._refreshed_at >= HEARTBEAT_INTERVAL:
+            self.refresh_workers()
+
+        with self._lock:
+            self._push(get_shard_key(update), update.to_dict())
+
+    def get_depths(self) -> list:
+        with self._lock:
+            worker_ids = sorted(self.ring.nodes)
+        pipeline = self.redis.pipeline(transaction=False)
+        for worker_id in worker_ids:
+            pipeline.llen(get_queue_key(worker_id))
+        return [
+            ([worker_id], depth)
+            for worker_id, depth in zip(worker_ids, pipeline.execute())
+        ]
+
+
+class ShardConsumer:
+    # runs in every worker process: announces the worker with heartbeats,
+    # feeds its share of updates into the local dispatcher and confirms
+    # handled updates once their state is flushed to Redis
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        updater: Updater,
+        worker_id: Optional[str] = None,
+        dispatcher_backlog: int = DISPATCHER_BACKLOG,
+    ):
+        self.redis = redis_connection
+        self.updater = updater
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.queue_key = get_queue_key(self.worker_id)
+        self.processed_key = get_processed_key(self.worker_id)
+        self.dispatcher_backlog = dispatcher_backlog
+        self._processed = {}
+        self._processed_lock = threading.Lock()
+        self._consuming_stopped = threading.Event()
+        self._left = threading.Event()
+
+    def heartbeat(self):
+        self.redis.zadd(WORKERS_KEY, {self.worker_id: time.time()})
+
+    def mark_processed(self, update: object):
+        # called by dispatcher workers once an update has been handled
+        if not isinstance(update, Update):
+            return
+        with self._processed_lock:
+            self._processed[str(get_shard_key(update))] = update.update_id
+
+    def confirm_processed(self):
+        with self._processed_lock:
+            processed, self._processed = self._processed, {}
+        if not processed:
+            return
+
+        try:
+            # the next owner of a user reloads the state from Redis
+            persistence = self.updater.dispatcher.persistence
+            if persistence:
+                persistence.flush()
+            self.redis.hset(self.processed_key, mapping=processed)
+        except redis.RedisError:
+            with self._processed_lock:
+                self._processed = {**processed, **self._processed}
+            raise
+
+    def _heartbeat_periodically(self):
+        while not self._left.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.heartbeat()
+                self.confirm_processed()
+            except redis.RedisError:
+                logger.exception("Shard worker heartbeat failed")
+
+    def _reload_state(self, update: Update):
+        persistence = self.updater.dispatcher.persistence
+        if isinstance(persistence, RedisPersistence):
+            persistence.reload(
+                user_id=update.effective_user and update.effective_user.id,
+                chat_id=update.effective_chat and update.effective_chat.id,
+            )
+
+    def consume(self):
+        update_queue = self.updater.dispatcher.update_queue
+        while not self._consuming_stopped.is_set():
+            while (
+                update_queue.qsize() >= self.dispatcher_backlog
+                and not self._consuming_stopped.is_set()
+            ):
+                time.sleep(0.01)
+            try:
+                item = self.redis.brpop(self.queue_key, timeout=1)
+            except redis.RedisError:
+                logger.exception("Couldn't take updates from the shard queue")
+                time.sleep(1)
+                continue
+            if item is None:
+                continue
+
+            _, update_json = item
+            update_details = json.loads(update_json)
+            update = Update.de_json(update_details["update"], self.updater.bot)
+            if update_details["is_moved"]:
+                self._reload_state(update)
+            update_queue.put(update)
+
+    def start(self):
+        self.heartbeat()
+        threading.Thread(target=self._heartbeat_periodically, daemon=True).start()
+        logger.info(f"Shard worker {self.worker_id} joined")
+
+    def stop_consuming(self):
+        # the worker keeps its heartbeat, so its users stay with it
+        self._consuming_stopped.set()
+
+    def leave(self):
+        self._left.set()
+        self.confirm_processed()
+        # an expired heartbeat makes the router hand the rest of the queue
+        # to the remaining workers right away
+        self.redis.zadd(WORKERS_KEY, {self.worker_id: 0})
+        logger.info(f"Shard worker {self.worker_id} left")
+
+
+def run_shard_worker(updater: Updater, consumer: ShardConsumer):
+    updater.dispatcher.on_processed = consumer.mark_processed
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, daemon=True)
+    dispatcher_thread.start()
+    updater.job_queue.start()
+    consumer.start()
+
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    consumer_thread = threading.Thread(target=consumer.consume, daemon=True)
+    consumer_thread.start()
+    stopped.wait()
+
+    consumer.stop_consuming()
+    consumer_thread.join()
+    # updates already taken from the queue are handled before the worker
+    # leaves the ring, otherwise their users would move while still in flight
+    while not updater.dispatcher.update_queue.empty():
+        time.sleep(0.1)
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    consumer.leave()
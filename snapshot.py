@@ -0,0 +1,153 @@
+import asyncio
+import json
+import logging
+import time
+import zlib
+from typing import Optional
+
+import redis
+
+import async_elastic_api
+import keyboards
+from catalog import CatalogCache
+from geocode import PizzeriaIndex
+from product_cache import ProductCache
+
+
+logger = logging.getLogger(__file__)
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_KEY = "catalog:snapshot"
+SNAPSHOT_INTERVAL = 10 * 60  # seconds
+
+
+def is_valid_snapshot(snapshot: object) -> bool:
+    return (
+        isinstance(snapshot, dict)
+        and snapshot.get("format") == SNAPSHOT_FORMAT
+        and isinstance(snapshot.get("created_at"), (int, float))
+        and isinstance(snapshot.get("products"), list)
+        and all(
+            isinstance(product, dict) and "id" in product
+            for product in snapshot["products"]
+        )
+        and isinstance(snapshot.get("file_hrefs"), dict)
+        and isinstance(snapshot.get("pizzerias"), list)
+    )
+
+
+class CatalogSnapshot:
+    # products, image hrefs and pizzerias as compressed JSON in a single
+    # Redis value, so a freshly deployed process serves the menu right away
+    def __init__(self, redis_connection: redis.Redis, key: str = SNAPSHOT_KEY):
+        self.redis = redis_connection
+        self.key = key
+
+    def save(self, products: list[dict], file_hrefs: dict, pizzerias: list[dict]):
+        snapshot = {
+            "format": SNAPSHOT_FORMAT,
+            "created_at": time.time(),
+            "products": products,
+            "file_hrefs": file_hrefs,
+            "pizzerias": pizzerias,
+        }
+        self.redis.set(
+            self.key, zlib.compress(json.dumps(snapshot, ensure_ascii=False).encode())
+        )
+
+    def load(self) -> Optional[dict]:
+        raw_snapshot = self.redis.get(self.key)
+        if raw_snapshot is None:
+            return None
+        # a broken snapshot only costs a cold start
+        try:
+            snapshot = json.loads(zlib.decompress(raw_snapshot))
+        except (zlib.error, ValueError):
+            logger.exception("Catalog snapshot is corrupted")
+            return None
+        if not is_valid_snapshot(snapshot):
+            logger.warning("Catalog snapshot has an unknown format")
+            return None
+
+        return snapshot
+
+
+def restore_snapshot(
+    catalog_snapshot: CatalogSnapshot,
+    catalog: CatalogCache,
+    product_cache: ProductCache,
+    pizzeria_index: PizzeriaIndex,
+):
+    started_at = time.perf_counter()
+    snapshot = catalog_snapshot.load()
+    if snapshot is None:
+        logger.info("No catalog snapshot, the catalog is loaded on first use")
+        return
+
+    catalog.load(snapshot["products"])
+    # served as is, but refreshed from Moltin on first use
+    catalog.invalidate()
+    for product in snapshot["products"]:
+        product_cache.warm_product(product["id"], {"data": product})
+    for file_id, file_href in snapshot["file_hrefs"].items():
+        product_cache.warm_file_href(file_id, file_href)
+    pizzeria_index.sync(snapshot["pizzerias"])
+
+    logger.info(
+        f"Catalog snapshot of {len(snapshot['products'])} products "
+        f"from {time.time() - snapshot['created_at']:.0f}s ago restored "
+        f"in {(time.perf_counter() - started_at) * 1000:.1f}ms"
+    )
+
+
+async def fetch_file_hrefs(elastic_token: str, file_ids: list[str]) -> list[str]:
+    # the client's connection pool keeps the number of parallel calls in check
+    return await asyncio.gather(
+        *(
+            async_elastic_api.get_file_href(
+                credential_token=elastic_token, file_id=file_id
+            )
+            for file_id in file_ids
+        )
+    )
+
+
+def take_snapshot(
+    catalog_snapshot: CatalogSnapshot,
+    catalog: CatalogCache,
+    product_cache: ProductCache,
+    pizzeria_index: PizzeriaIndex,
+    elastic_token: str,
+):
+    pizzerias = pizzeria_index.get_pizzerias()
+    if not pizzerias:
+        # pizzerias failed to load, keep the previous snapshot
+        logger.warning("No pizzerias loaded, catalog snapshot skipped")
+        return
+
+    # reconciles the catalog with Moltin before it is written down
+    catalog.refresh(elastic_token)
+    _, pages = catalog.get_pages(elastic_token)
+    products = [product for page in pages for product in page]
+
+    file_ids = [
+        keyboards.get_main_image_id({"data": product})
+        for product in products
+        if product.get("relationships", {}).get("main_image")
+    ]
+    file_hrefs = {file_id: product_cache.get_file_href(file_id) for file_id in file_ids}
+    missing_file_ids = [file_id for file_id, href in file_hrefs.items() if not href]
+    if missing_file_ids:
+        fetched_hrefs = async_elastic_api.run(
+            fetch_file_hrefs(elastic_token, missing_file_ids)
+        )
+        for file_id, file_href in zip(missing_file_ids, fetched_hrefs):
+            product_cache.set_file_href(file_id, file_href)
+            file_hrefs[file_id] = file_href
+
+    catalog_snapshot.save(
+        products=products,
+        file_hrefs=file_hrefs,
+        pizzerias=pizzerias,
+    )
+    logger.info(f"Catalog snapshot of {len(products)} products saved")
@@ -1,30 +1,67 @@
 import logging
+import multiprocessing
 import os
-import time
+from collections import Counter
+from concurrent.futures import Future
+from queue import Queue
 from enum import Enum, auto
+from functools import partial
 from textwrap import dedent
 
+import httpx
 import redis
+import requests
 from dotenv import load_dotenv
-from telegram import Update, LabeledPrice
+from telegram import (
+    Bot,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    LabeledPrice,
+    Update,
+)
 from telegram.ext import (
     CallbackContext,
+    JobQueue,
     CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
     Filters,
+    InlineQueryHandler,
     MessageHandler,
     Updater,
     PreCheckoutQueryHandler,
 )
+from telegram.error import BadRequest
 
 import elastic_api
 import keyboards
 import geocode
+import metrics
+import webhook
+from cart_mirror import CartMirror
+from catalog import CatalogCache
+from delayed_jobs import DelayedJobScheduler
+from media import MediaCache
+from outbox import GLOBAL_RATE, Outbox, Priority
+from persistence import RedisPersistence
+from product_cache import ProductCache
+from search import ProductSearchIndex
+from sharding import ShardConsumer, ShardRouter, run_shard_worker
+from snapshot import SNAPSHOT_INTERVAL, CatalogSnapshot, restore_snapshot, take_snapshot
+from token_manager import ElasticTokenManager
+from workers import OrderedDispatcher
+from write_behind import CoordinatesWriter
 
 
 logger = logging.getLogger(__file__)
 
+BOT_WORKERS = 8
+WORKER_STATS_INTERVAL = 60  # seconds
+PIZZERIAS_REFRESH_INTERVAL = 300  # seconds
+SNAPSHOT_FIRST_DELAY = 30  # seconds, lets the pizzerias load first
+DELIVERY_REMINDER_DELAY = 10  # seconds
+INLINE_QUERY_CACHE_TIME = 60  # seconds
+
 
 class State(Enum):
     HANDLE_MENU = auto()
@@ -39,39 +76,47 @@ def error_handler(update: Update, context: CallbackContext):
     logger.error(msg="Telegram bot encountered an error", exc_info=context.error)
 
 
-def validate_token_expiration(function_to_decorate):
-    def wrapper(*args, **kwagrs):
-        update, context = args
-        token_expiration_time = context.bot_data.get("token_expires")
-        current_time = time.time()
+def count_conversation_states(conversation: ConversationHandler) -> list:
+    states_population = Counter(
+        state.name for state in list(conversation.conversations.values()) if state
+    )
+    return [([state], population) for state, population in states_population.items()]
 
-        if current_time >= token_expiration_time:
-            logger.info("Getting new Elastic token due to expiration.")
 
-            client_id = context.bot_data["elastic_client_id"]
-            client_secret = context.bot_data["elastic_client_secret"]
-            new_elastic_token = elastic_api.get_credential_token(
-                client_id, client_secret
-            )
+def refresh_pizzerias(context: CallbackContext):
+    all_pizzerias = elastic_api.get_all_entries(
+        credential_token=context.bot_data["token_manager"].get_token(),
+        slug="pizzeria",
+    )
+    context.bot_data["pizzeria_index"].sync(all_pizzerias["data"])
 
-            context.bot_data["elastic_token"] = new_elastic_token["access_token"]
-            context.bot_data["token_expires"] = new_elastic_token["expires"]
 
-            updated_args = update, context
-            return function_to_decorate(*updated_args, **kwagrs)
+def save_catalog_snapshot(context: CallbackContext):
+    try:
+        take_snapshot(
+            catalog_snapshot=context.bot_data["catalog_snapshot"],
+            catalog=context.bot_data["catalog"],
+            product_cache=context.bot_data["product_cache"],
+            pizzeria_index=context.bot_data["pizzeria_index"],
+            elastic_token=context.bot_data["token_manager"].get_token(),
+        )
+    except (requests.RequestException, httpx.HTTPError, redis.RedisError):
+        logger.exception("Couldn't save the catalog snapshot")
 
-        return function_to_decorate(*args, **kwagrs)
 
-    return wrapper
+def log_worker_stats(context: CallbackContext):
+    for worker_stats in context.dispatcher.pool.get_stats():
+        logger.info(f"Dispatcher worker stats: {worker_stats}")
 
 
-@validate_token_expiration
+@metrics.track_handler
 def handle_menu(update: Update, context: CallbackContext) -> State:
     query = update.callback_query
     button_pressed = query.data if query else update.message.text
 
     welcome_text, menu_markup = keyboards.get_menu_markup(
-        elastic_token=context.bot_data.get("elastic_token"),
+        catalog=context.bot_data["catalog"],
+        elastic_token=context.bot_data["token_manager"].get_token(),
         user_first_name=update.effective_user.first_name,
         button_pressed=button_pressed,
     )
@@ -85,39 +130,90 @@ def handle_menu(update: Update, context: CallbackContext) -> State:
     return State.HANDLE_DESCRIPTION
 
 
-@validate_token_expiration
+@metrics.track_handler
 def handle_description(update: Update, context: CallbackContext) -> State:
     query = update.callback_query
-    context.bot_data["product_id"] = query.data
+    context.user_data["product_id"] = query.data
 
     (
         picture_href,
         product_description,
         description_markup,
     ) = keyboards.get_description_markup(
-        elastic_token=context.bot_data.get("elastic_token"),
+        product_cache=context.bot_data["product_cache"],
+        cart_mirror=context.bot_data["cart_mirror"],
+        elastic_token=context.bot_data["token_manager"].get_token(),
         product_id=query.data,
         user_id=update.effective_user.id,
     )
 
-    update.effective_user.send_photo(
-        photo=picture_href,
-        caption=dedent(product_description),
-        reply_markup=description_markup,
-    )
+    media_cache = context.bot_data["media_cache"]
+    photo, is_cached = media_cache.get_photo(query.data, picture_href)
+    try:
+        message = update.effective_user.send_photo(
+            photo=photo,
+            caption=dedent(product_description),
+            reply_markup=description_markup,
+        )
+    except BadRequest:
+        if not is_cached:
+            raise
+        # the file_id was issued to another bot token, upload again
+        media_cache.forget(query.data, picture_href)
+        return handle_description(update, context)
+    if not is_cached:
+        media_cache.remember(query.data, picture_href, message)
     update.effective_message.delete()
 
     return State.HANDLE_DESCRIPTION
 
 
-@validate_token_expiration
+@metrics.track_handler
+def handle_search(update: Update, context: CallbackContext) -> State:
+    found_products = keyboards.get_search_results(
+        catalog=context.bot_data["catalog"],
+        search_index=context.bot_data["search_index"],
+        elastic_token=context.bot_data["token_manager"].get_token(),
+        query=update.message.text,
+    )
+    search_text, search_markup = keyboards.get_search_markup(found_products)
+
+    update.effective_user.send_message(text=search_text, reply_markup=search_markup)
+
+    return State.HANDLE_DESCRIPTION
+
+
+@metrics.track_handler
+def handle_inline_query(update: Update, context: CallbackContext):
+    query = update.inline_query
+    found_products = keyboards.get_search_results(
+        catalog=context.bot_data["catalog"],
+        search_index=context.bot_data["search_index"],
+        elastic_token=context.bot_data["token_manager"].get_token(),
+        query=query.query,
+    )
+    # the chosen pizza lands in the chat as its name, which handle_search
+    # turns into a button for its description
+    results = [
+        InlineQueryResultArticle(
+            id=product["id"],
+            title=product["name"],
+            description=product["meta"]["display_price"]["with_tax"]["formatted"],
+            input_message_content=InputTextMessageContent(product["name"]),
+        )
+        for product in found_products
+    ]
+    query.answer(results, cache_time=INLINE_QUERY_CACHE_TIME)
+
+
+@metrics.track_handler
 def handle_add_to_cart(update: Update, context: CallbackContext) -> State:
     query = update.callback_query
     query.answer("Товар добавлен в корзину")
 
-    elastic_api.add_product_to_cart(
-        credential_token=context.bot_data.get("elastic_token"),
-        product_id=context.bot_data["product_id"],
+    context.bot_data["cart_mirror"].add_product(
+        elastic_token=context.bot_data["token_manager"].get_token(),
+        product_id=context.user_data["product_id"],
         quantity=int(query.data),
         cart_id=update.effective_user.id,
     )
@@ -125,13 +221,13 @@ def handle_add_to_cart(update: Update, context: CallbackContext) -> State:
     return State.HANDLE_DESCRIPTION
 
 
-@validate_token_expiration
+@metrics.track_handler
 def handle_delete_from_cart(update: Update, context: CallbackContext) -> State:
     query = update.callback_query
     query.answer("Товар удален из корзины")
 
-    elastic_api.delete_product_from_cart(
-        credential_token=context.bot_data.get("elastic_token"),
+    context.bot_data["cart_mirror"].delete_product(
+        elastic_token=context.bot_data["token_manager"].get_token(),
         cart_id=update.effective_user.id,
         product_id=query.data,
     )
@@ -140,10 +236,11 @@ def handle_delete_from_cart(update: Update, context: CallbackContext) -> State:
     return State.HANDLE_CART
 
 
-@validate_token_expiration
+@metrics.track_handler
 def handle_cart(update: Update, context: CallbackContext) -> State:
     total_price, cart_summary_text, cart_markup = keyboards.get_cart_markup(
-        elastic_token=context.bot_data.get("elastic_token"),
+        cart_mirror=context.bot_data["cart_mirror"],
+        elastic_token=context.bot_data["token_manager"].get_token(),
         cart_id=update.effective_user.id,
     )
     context.user_data["total_price"] = total_price
@@ -157,9 +254,15 @@ def handle_cart(update: Update, context: CallbackContext) -> State:
     return State.HANDLE_CART
 
 
-@validate_token_expiration
+@metrics.track_handler
 def handle_location(update: Update, context: CallbackContext) -> State:
-    query = update.callback_query
+    # the price to pay is taken from Moltin, not from the cart mirror
+    cart_items = context.bot_data["cart_mirror"].reconcile(
+        elastic_token=context.bot_data["token_manager"].get_token(),
+        cart_id=update.effective_user.id,
+    )
+    context.user_data["total_price"] = keyboards.get_cart_total_price(cart_items)
+
     location_text, location_markup = keyboards.get_location_markup(
         user_first_name=update.effective_user.first_name
     )
@@ -173,7 +276,20 @@ def handle_location(update: Update, context: CallbackContext) -> State:
     return State.HANDLE_LOCATION
 
 
-@validate_token_expiration
+def ask_location_again(update: Update, error_text: str) -> State:
+    location_text, location_markup = keyboards.get_location_markup(
+        user_first_name=update.effective_user.first_name
+    )
+    update.effective_user.send_message(error_text)
+    update.effective_user.send_message(
+        text=dedent(location_text),
+        reply_markup=location_markup,
+    )
+    update.effective_message.delete()
+    return State.HANDLE_LOCATION
+
+
+@metrics.track_handler
 def handle_delivery(update: Update, context: CallbackContext) -> State:
     # address was sent in location with coordinates format
     if update.message.location:
@@ -185,23 +301,24 @@ def handle_delivery(update: Update, context: CallbackContext) -> State:
     # address was sent in text format
     else:
         try:
-            user_coordinates = geocode.get_coordinates(
+            user_coordinates = geocode.get_cached_coordinates(
+                redis_connection=context.bot_data["redis"],
                 yandex_token=context.bot_data.get("geocode_token"),
                 address=update.message.text,
             )
 
-        # address wasn't recognized
         except IndexError:
-            location_text, location_markup = keyboards.get_location_markup(
-                user_first_name=update.effective_user.first_name
+            return ask_location_again(update, "Адрес не распознан. Повторите попытку.")
+
+        # the geocoder is down or its circuit breaker is open, so retyping
+        # the address won't help until it is back
+        except requests.RequestException:
+            logger.exception("Couldn't geocode the address")
+            return ask_location_again(
+                update,
+                "Сервис распознавания адресов временно недоступен. "
+                "Пришлите, пожалуйста, свою геолокацию.",
             )
-            update.effective_user.send_message("Адрес не распознан. Повторите попытку.")
-            update.effective_user.send_message(
-                text=dedent(location_text),
-                reply_markup=location_markup,
-            )
-            update.effective_message.delete()
-            return State.HANDLE_LOCATION
 
     (
         nearest_pizzeria,
@@ -209,12 +326,14 @@ def handle_delivery(update: Update, context: CallbackContext) -> State:
         delivery_price,
         delivery_markup,
     ) = keyboards.get_delivery_markup(
-        elastic_token=context.bot_data.get("elastic_token"),
+        pizzeria_index=context.bot_data["pizzeria_index"],
+        coordinates_writer=context.bot_data["coordinates_writer"],
+        elastic_token=context.bot_data["token_manager"].get_token(),
         user_coordinates=user_coordinates,
         user_id=update.effective_user.id,
     )
-    context.bot_data["pizzeria"] = nearest_pizzeria
-    context.bot_data["coordinates"] = user_coordinates
+    context.user_data["pizzeria"] = nearest_pizzeria
+    context.user_data["coordinates"] = user_coordinates
     context.user_data["delivery_price"] = delivery_price
 
     update.effective_user.send_message(
@@ -229,35 +348,47 @@ def handle_delivery(update: Update, context: CallbackContext) -> State:
     return State.HANDLE_DELIVERY
 
 
+@metrics.track_handler
 def handle_courier_notification(update: Update, context: CallbackContext) -> State:
-    pizzeria_courier = context.bot_data["pizzeria"]["courier"]
-    longitude, latitude = context.bot_data["coordinates"]
+    pizzeria_courier = context.user_data["pizzeria"]["courier"]
+    longitude, latitude = context.user_data["coordinates"]
 
-    context.bot.send_message(
+    outbox = context.bot_data["outbox"]
+    outbox.send(
+        "send_message",
         chat_id=pizzeria_courier,
+        priority=Priority.COURIER,
         text="Сообщение для курьера. Доставьте заказ.",
     )
-    context.bot.send_location(
+    outbox.send(
+        "send_location",
         chat_id=pizzeria_courier,
+        priority=Priority.COURIER,
         longitude=longitude,
         latitude=latitude,
     )
 
     handle_payment(update, context)
 
-    context.job_queue.run_once(
-        callback=remind_delivery_status,
-        when=10,  # seconds
-        context=update.effective_user.id,
+    # a redelivered update carries the same callback query id
+    context.bot_data["delayed_jobs"].schedule(
+        "remind_delivery_status",
+        payload={"chat_id": update.effective_user.id},
+        delay=DELIVERY_REMINDER_DELAY,
+        idempotency_key=f"remind_delivery_status:{update.callback_query.id}",
     )
 
     return State.HANDLE_DELIVERY
 
 
-def remind_delivery_status(context: CallbackContext):
-    job = context.job
-    context.bot.send_message(
-        chat_id=job.context,
+@metrics.track_handler
+def remind_delivery_status(payload: dict, outbox: Outbox) -> Future:
+    # the job is done once Telegram takes the message, a reminder dropped by
+    # the outbox is fired again after the lease is over
+    return outbox.send(
+        "send_message",
+        chat_id=payload["chat_id"],
+        priority=Priority.MARKETING,
         text=dedent(
             f"""
             Приятного аппетита! *место для рекламы*
@@ -266,12 +397,11 @@ def remind_delivery_status(context: CallbackContext):
         ),
     )
 
-    return State.HANDLE_DELIVERY
-
 
+@metrics.track_handler
 def handle_pickup(update: Update, context: CallbackContext) -> State:
     pickup_text, pickup_markup = keyboards.get_pickup_markup(
-        nearest_pizzeria=context.bot_data["pizzeria"]
+        nearest_pizzeria=context.user_data["pizzeria"]
     )
 
     update.effective_user.send_message(
@@ -283,12 +413,15 @@ def handle_pickup(update: Update, context: CallbackContext) -> State:
     return State.HANDLE_DELIVERY
 
 
+@metrics.track_handler
 def handle_payment(update: Update, context: CallbackContext) -> State:
     total_price = context.user_data.get("total_price")
     delivery_price = context.user_data.get("delivery_price")
 
-    context.bot.send_invoice(
+    context.bot_data["outbox"].send(
+        "send_invoice",
         chat_id=update.effective_user.id,
+        priority=Priority.PAYMENT,
         title="Пиццерия 'Pizza time'",
         description=f"Пожалуйста, оплатите ваш заказ",
         payload=f"user_id {update.effective_user.id}",
@@ -304,6 +437,7 @@ def handle_payment(update: Update, context: CallbackContext) -> State:
     return State.HANDLE_PAYMENT
 
 
+@metrics.track_handler
 def precheckout_callback(update: Update, context: CallbackContext) -> State:
     query = update.pre_checkout_query
 
@@ -325,16 +459,78 @@ def run_bot(
     elastic_client_secret: str,
     geocode_token: str,
     payment_token: str,
+    telegram_mode: str = "polling",
+    webhook_listen: str = "0.0.0.0",
+    webhook_port: int = 8443,
+    webhook_url: str = None,
+    webhook_secret: str = None,
+    webhook_queue_size: int = webhook.INGESTION_QUEUE_SIZE,
+    workers: int = BOT_WORKERS,
+    metrics_port: int = None,
+    telegram_api_url: str = None,
+    shard_count: int = 1,
 ):
-    updater = Updater(token=telegram_token, use_context=True)
-    dispatcher = updater.dispatcher
+    # every worker thread may fetch catalog pages concurrently
+    elastic_api.configure_session(pool_size=workers * elastic_api.PAGE_FETCH_CONCURRENCY)
+
+    bot = Bot(
+        token=telegram_token,
+        base_url=telegram_api_url,
+        request=metrics.InstrumentedRequest(con_pool_size=workers + 4),
+    )
+    dispatcher = OrderedDispatcher(
+        bot=bot,
+        update_queue=Queue(),
+        job_queue=JobQueue(),
+        persistence=RedisPersistence(redis_connection),
+        use_context=True,
+        ordered_workers=workers,
+    )
+    # Updater only binds the job queue of a dispatcher it creates itself
+    dispatcher.job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
     dispatcher.bot_data["redis"] = redis_connection
-    dispatcher.bot_data["elastic_token"] = elastic_token["access_token"]
-    dispatcher.bot_data["token_expires"] = elastic_token["expires"]
-    dispatcher.bot_data["elastic_client_id"] = elastic_client_id
-    dispatcher.bot_data["elastic_client_secret"] = elastic_client_secret
+    token_manager = ElasticTokenManager(
+        redis_connection=redis_connection,
+        client_id=elastic_client_id,
+        client_secret=elastic_client_secret,
+        credential_token=elastic_token,
+    )
+    token_manager.start()
+    dispatcher.bot_data["token_manager"] = token_manager
     dispatcher.bot_data["geocode_token"] = geocode_token
     dispatcher.bot_data["payment_token"] = payment_token
+    dispatcher.bot_data["catalog"] = CatalogCache(
+        page_renderer=keyboards.get_menu_page_markup
+    )
+    dispatcher.bot_data["product_cache"] = ProductCache(redis_connection)
+    dispatcher.bot_data["media_cache"] = MediaCache(redis_connection)
+    dispatcher.bot_data["search_index"] = ProductSearchIndex()
+    dispatcher.bot_data["cart_mirror"] = CartMirror(redis_connection)
+    dispatcher.bot_data["pizzeria_index"] = geocode.PizzeriaIndex()
+    catalog_snapshot = CatalogSnapshot(redis_connection)
+    restore_snapshot(
+        catalog_snapshot=catalog_snapshot,
+        catalog=dispatcher.bot_data["catalog"],
+        product_cache=dispatcher.bot_data["product_cache"],
+        pizzeria_index=dispatcher.bot_data["pizzeria_index"],
+    )
+    dispatcher.bot_data["catalog_snapshot"] = catalog_snapshot
+    coordinates_writer = CoordinatesWriter(
+        redis_connection=redis_connection, get_elastic_token=token_manager.get_token
+    )
+    coordinates_writer.start()
+    dispatcher.bot_data["coordinates_writer"] = coordinates_writer
+    # the Telegram-wide flood limit is split evenly between the shards
+    outbox = Outbox(bot, global_rate=GLOBAL_RATE / shard_count)
+    outbox.start()
+    dispatcher.bot_data["outbox"] = outbox
+    delayed_jobs = DelayedJobScheduler(redis_connection)
+    delayed_jobs.register(
+        "remind_delivery_status", partial(remind_delivery_status, outbox=outbox)
+    )
+    delayed_jobs.start()
+    dispatcher.bot_data["delayed_jobs"] = delayed_jobs
 
     conversation = ConversationHandler(
         entry_points=[CommandHandler("start", handle_menu)],
@@ -349,6 +545,7 @@ def run_bot(
                 CallbackQueryHandler(handle_menu, pattern="^page [0-9]"),
                 CallbackQueryHandler(handle_add_to_cart, pattern="^[0-9]+$"),
                 CallbackQueryHandler(handle_description),
+                MessageHandler(Filters.text & ~Filters.command, handle_search),
             ],
             State.HANDLE_CART: [
                 CallbackQueryHandler(handle_menu, pattern="back"),
@@ -362,9 +559,7 @@ def run_bot(
                 CallbackQueryHandler(handle_menu, pattern="back"),
             ],
             State.HANDLE_DELIVERY: [
-                CallbackQueryHandler(
-                    handle_courier_notification, pattern="delivery", pass_job_queue=True
-                ),
+                CallbackQueryHandler(handle_courier_notification, pattern="delivery"),
                 CallbackQueryHandler(handle_pickup, pattern="pickup"),
             ],
             State.HANDLE_PAYMENT: [
@@ -372,28 +567,155 @@ def run_bot(
             ],
         },
         fallbacks=[],
+        name="pizza_conversation",
+        persistent=True,
     )
     dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+    dispatcher.add_handler(InlineQueryHandler(handle_inline_query))
     dispatcher.add_handler(conversation)
     dispatcher.add_error_handler(error_handler)
 
-    updater.start_polling()
-    updater.idle()
+    metrics.register_gauge(
+        "bot_conversations",
+        "Conversations in every state",
+        ["state"],
+        lambda: count_conversation_states(conversation),
+    )
+    metrics.register_gauge(
+        "bot_worker_queue_depth",
+        "Updates waiting for a dispatcher worker",
+        ["worker"],
+        lambda: [
+            ([str(worker_stats["worker"])], worker_stats["queue_depth"])
+            for worker_stats in dispatcher.pool.get_stats()
+        ],
+    )
+    metrics.register_gauge(
+        "bot_outbox_depth",
+        "Outbound messages waiting for a flood limit slot",
+        ["priority"],
+        outbox.get_depth,
+    )
+    metrics.register_gauge(
+        "bot_delayed_jobs_pending",
+        "Delayed jobs waiting to fire",
+        [],
+        lambda: [([], delayed_jobs.get_pending_count())],
+    )
+    metrics.register_gauge(
+        "bot_delayed_jobs_lag_seconds",
+        "How overdue the oldest delayed job is",
+        [],
+        lambda: [([], delayed_jobs.get_lag())],
+    )
+    metrics.register_gauge(
+        "bot_circuit_state",
+        "Circuit breakers: 0 closed, 1 half open, 2 open",
+        ["service", "endpoint"],
+        lambda: elastic_api.moltin_guard.get_states() + geocode.yandex_guard.get_states(),
+    )
+    if metrics_port:
+        metrics.start_metrics_server(metrics_port)
+    dispatcher.job_queue.run_repeating(
+        log_worker_stats, interval=WORKER_STATS_INTERVAL
+    )
+    dispatcher.job_queue.run_repeating(
+        refresh_pizzerias, interval=PIZZERIAS_REFRESH_INTERVAL, first=0
+    )
+    dispatcher.job_queue.run_repeating(
+        save_catalog_snapshot,
+        interval=SNAPSHOT_INTERVAL,
+        first=SNAPSHOT_FIRST_DELAY,
+    )
+
+    logger.info(f"Telegram bot started in {telegram_mode} mode")
+    if telegram_mode == "webhook":
+        webhook.run_webhook(
+            updater=updater,
+            listen=webhook_listen,
+            port=webhook_port,
+            webhook_url=webhook_url,
+            secret_token=webhook_secret,
+            queue_size=webhook_queue_size,
+        )
+    elif telegram_mode == "shard":
+        run_shard_worker(
+            updater=updater,
+            consumer=ShardConsumer(redis_connection=redis_connection, updater=updater),
+        )
+    else:
+        updater.start_polling()
+        updater.idle()
+
 
-    logger.info("Telegram bot started")
+def run_ingestion(
+    telegram_token: str,
+    redis_connection: redis.Redis,
+    webhook_listen: str = "0.0.0.0",
+    webhook_port: int = 8443,
+    webhook_url: str = None,
+    webhook_secret: str = None,
+    webhook_queue_size: int = webhook.INGESTION_QUEUE_SIZE,
+    metrics_port: int = None,
+    telegram_api_url: str = None,
+):
+    # the webhook endpoint alone, updates are handled by the shard workers
+    bot = Bot(token=telegram_token, base_url=telegram_api_url)
+    updater = Updater(bot=bot)
+    router = ShardRouter(redis_connection)
+
+    metrics.register_gauge(
+        "bot_shard_queue_depth",
+        "Updates waiting for a shard worker",
+        ["worker"],
+        router.get_depths,
+    )
+    if metrics_port:
+        metrics.start_metrics_server(metrics_port)
+
+    logger.info("Telegram bot ingestion started")
+    webhook.run_webhook(
+        updater=updater,
+        listen=webhook_listen,
+        port=webhook_port,
+        webhook_url=webhook_url,
+        secret_token=webhook_secret,
+        queue_size=webhook_queue_size,
+        router=router,
+    )
 
 
-def main():
+def run_sharded(shard_processes: int, **ingestion_settings):
+    # spawned rather than forked, the parent has live Redis connections
+    context = multiprocessing.get_context("spawn")
+    shards = [
+        context.Process(
+            target=main,
+            kwargs={"telegram_mode": "shard", "shard_index": shard_index},
+            name=f"shard:{shard_index}",
+        )
+        for shard_index in range(shard_processes)
+    ]
+    for shard in shards:
+        shard.start()
+
+    try:
+        run_ingestion(**ingestion_settings)
+    finally:
+        for shard in shards:
+            shard.terminate()
+        for shard in shards:
+            shard.join()
+
+
+def main(telegram_mode: str = None, shard_index: int = 0):
     logging.basicConfig(level=logging.INFO)
 
     load_dotenv()
     telegram_token = os.getenv("TELEGRAM_TOKEN")
-
-    elastic_client_id = os.getenv("ELASTIC_CLIENT_ID")
-    elastic_client_secret = os.getenv("ELASTIC_CLIENT_SECRET")
-    elastic_token = elastic_api.get_credential_token(
-        client_id=elastic_client_id, client_secret=elastic_client_secret
-    )
+    telegram_mode = telegram_mode or os.getenv("TELEGRAM_MODE", "polling")
+    metrics_port = int(os.getenv("METRICS_PORT", 0))
+    shard_processes = int(os.getenv("SHARD_PROCESSES", os.cpu_count()))
 
     redis_connection = redis.Redis(
         host=os.getenv("REDIS_HOST"),
@@ -402,6 +724,38 @@ def main():
         password=os.getenv("REDIS_PASSWORD"),
     )
 
+    webhook_settings = {
+        "webhook_listen": os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+        "webhook_port": int(os.getenv("WEBHOOK_PORT", 8443)),
+        "webhook_url": os.getenv("WEBHOOK_URL"),
+        "webhook_secret": os.getenv("WEBHOOK_SECRET"),
+        "webhook_queue_size": int(
+            os.getenv("WEBHOOK_QUEUE_SIZE", webhook.INGESTION_QUEUE_SIZE)
+        ),
+    }
+    if telegram_mode == "sharded":
+        run_sharded(
+            shard_processes=shard_processes,
+            telegram_token=telegram_token,
+            redis_connection=redis_connection,
+            metrics_port=metrics_port,
+            telegram_api_url=os.getenv("TELEGRAM_API_URL"),
+            **webhook_settings,
+        )
+        return
+
+    elastic_client_id = os.getenv("ELASTIC_CLIENT_ID")
+    elastic_client_secret = os.getenv("ELASTIC_CLIENT_SECRET")
+    # shards pick the token another process published to Redis
+    elastic_token = None
+    if telegram_mode != "shard":
+        elastic_token = elastic_api.get_credential_token(
+            client_id=elastic_client_id, client_secret=elastic_client_secret
+        )
+    # every shard serves its own metrics next to the ingestion ones
+    if metrics_port and telegram_mode == "shard":
+        metrics_port += shard_index + 1
+
     yandex_geocode_token = os.getenv("YANDEX_GEOCODE_TOKEN")
     sber_payment_token = os.getenv("SBER_PAYMENT_TOKEN")
 
@@ -413,6 +767,12 @@ def main():
         elastic_client_secret=elastic_client_secret,
         geocode_token=yandex_geocode_token,
         payment_token=sber_payment_token,
+        telegram_mode=telegram_mode,
+        workers=int(os.getenv("BOT_WORKERS", BOT_WORKERS)),
+        metrics_port=metrics_port,
+        **webhook_settings,
+        telegram_api_url=os.getenv("TELEGRAM_API_URL"),
+        shard_count=shard_processes if telegram_mode == "shard" else 1,
     )
 
 
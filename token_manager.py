@@ -0,0 +1,115 @@
+import json
+import logging
+import threading
+import time
+from typing import Optional
+
+import redis
+import requests
+
+import elastic_api
+
+
+logger = logging.getLogger(__file__)
+
+REFRESH_MARGIN = 120  # seconds before expiration
+REFRESH_LOCK_TIMEOUT = 30  # seconds
+RETRY_DELAY = 5  # seconds
+
+
+class ElasticTokenManager:
+    # the token is refreshed ahead of expiration by a background thread;
+    # a lock in process and a Redis lock across processes make sure only one
+    # refresh happens at a time, everybody else picks the token from Redis
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        client_id: str,
+        client_secret: str,
+        credential_token: Optional[dict] = None,
+        refresh_margin: int = REFRESH_MARGIN,
+        redis_key: str = "elastic:token",
+    ):
+        self.redis = redis_connection
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.redis_key = redis_key
+        self.credential_token = credential_token
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._refresher = None
+
+        if credential_token:
+            self._publish(credential_token)
+
+    def _is_fresh(self, credential_token: Optional[dict]) -> bool:
+        return bool(credential_token) and (
+            credential_token["expires"] - self.refresh_margin > time.time()
+        )
+
+    def _publish(self, credential_token: dict):
+        self.redis.set(
+            self.redis_key,
+            json.dumps(credential_token),
+            exat=int(credential_token["expires"]),
+        )
+
+    def _read_published(self) -> Optional[dict]:
+        published_token = self.redis.get(self.redis_key)
+        return json.loads(published_token) if published_token else None
+
+    def refresh(self) -> dict:
+        with self._lock:
+            if self._is_fresh(self.credential_token):
+                return self.credential_token
+
+            published_token = self._read_published()
+            if not self._is_fresh(published_token):
+                with self.redis.lock(
+                    f"{self.redis_key}:lock",
+                    timeout=REFRESH_LOCK_TIMEOUT,
+                    blocking_timeout=REFRESH_LOCK_TIMEOUT,
+                ):
+                    published_token = self._read_published()
+                    if not self._is_fresh(published_token):
+                        logger.info("Getting new Elastic token due to expiration.")
+                        published_token = elastic_api.get_credential_token(
+                            self.client_id, self.client_secret
+                        )
+                        self._publish(published_token)
+
+            self.credential_token = published_token
+            return published_token
+
+    def get_token(self) -> str:
+        credential_token = self.credential_token
+        # the background refresher normally keeps the token fresh, this only
+        # happens if it fell behind or was never started
+        if not credential_token or credential_token["expires"] <= time.time():
+            credential_token = self.refresh()
+
+        return credential_token["access_token"]
+
+    def _refresh_periodically(self):
+        delay = 0
+        while not self._stopped.wait(delay):
+            try:
+                credential_token = self.refresh()
+            except (redis.RedisError, requests.RequestException):
+                logger.exception("Failed to refresh Elastic token")
+                delay = RETRY_DELAY
+                continue
+            delay = max(
+                credential_token["expires"] - self.refresh_margin - time.time(),
+                RETRY_DELAY,
+            )
+
+    def start(self):
+        self._refresher = threading.Thread(
+            target=self._refresh_periodically, daemon=True
+        )
+        self._refresher.start()
+
+    def stop(self):
+        self._stopped.set()
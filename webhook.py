@@ -0,0 +1,184 @@
+import hmac
+import json
+import logging
+import queue
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import redis
+from telegram import Update
+from telegram.ext import Updater
+
+from sharding import NoShardWorkersError, ShardRouter
+
+
+logger = logging.getLogger(__file__)
+
+WEBHOOK_PATH = "/telegram"
+INGESTION_QUEUE_SIZE = 1000
+DISPATCHER_BACKLOG = 100
+RETRY_AFTER = 1  # seconds
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        updater: Updater,
+        listen: str,
+        port: int,
+        secret_token: Optional[str] = None,
+        queue_size: int = INGESTION_QUEUE_SIZE,
+        dispatcher_backlog: int = DISPATCHER_BACKLOG,
+        router: Optional[ShardRouter] = None,
+    ):
+        super().__init__((listen, port), WebhookRequestHandler)
+        self.updater = updater
+        self.router = router
+        self.secret_token = secret_token
+        self.ingestion_queue = queue.Queue(maxsize=queue_size)
+        self.dispatcher_backlog = dispatcher_backlog
+        self._stopped = threading.Event()
+
+    def pump_updates(self):
+        # hands updates to the dispatcher only while its backlog is short,
+        # so a saturated dispatcher fills the ingestion queue and the
+        # endpoint starts asking Telegram to retry later
+        update_queue = self.updater.dispatcher.update_queue
+        while not self._stopped.is_set():
+            try:
+                update = self.ingestion_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            while (
+                update_queue.qsize() >= self.dispatcher_backlog
+                and not self._stopped.is_set()
+            ):
+                time.sleep(0.01)
+            update_queue.put(update)
+
+    def route_updates(self):
+        # hands updates to the shard worker processes through Redis instead
+        # of a local dispatcher
+        while not self._stopped.is_set():
+            try:
+                update = self.ingestion_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            while not self._stopped.is_set():
+                try:
+                    self.router.route(update)
+                    break
+                except NoShardWorkersError:
+                    logger.warning("No shard worker is alive, holding updates")
+                    time.sleep(RETRY_AFTER)
+                except redis.RedisError:
+                    logger.exception("Couldn't route an update to a shard worker")
+                    time.sleep(RETRY_AFTER)
+
+    def stop(self):
+        self._stopped.set()
+        self.shutdown()
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    server: WebhookServer
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _reply(self, status: int, headers: dict = None):
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            return self._reply(404)
+
+        if self.server.secret_token:
+            secret_token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(secret_token, self.server.secret_token):
+                return self._reply(403)
+
+        content_length = int(self.headers.get("Content-Length", 0))
+        try:
+            update_details = json.loads(self.rfile.read(content_length))
+            # a list, a scalar or an empty object is valid json but not an update
+            if not isinstance(update_details, dict) or not update_details:
+                raise ValueError("Update must be a non-empty JSON object")
+            update = Update.de_json(update_details, self.server.updater.bot)
+        except (ValueError, TypeError):
+            return self._reply(400)
+
+        try:
+            self.server.ingestion_queue.put_nowait(update)
+        except queue.Full:
+            return self._reply(503, {"Retry-After": str(RETRY_AFTER)})
+
+        self._reply(200)
+
+
+def set_webhook(updater: Updater, webhook_url: str, secret_token: Optional[str]):
+    bot = updater.bot
+    # python-telegram-bot 13 has no secret_token argument in set_webhook
+    webhook_details = {"url": webhook_url}
+    if secret_token:
+        webhook_details["secret_token"] = secret_token
+    bot.request.post(f"{bot.base_url}/setWebhook", webhook_details)
+
+
+def run_webhook(
+    updater: Updater,
+    listen: str,
+    port: int,
+    webhook_url: Optional[str] = None,
+    secret_token: Optional[str] = None,
+    queue_size: int = INGESTION_QUEUE_SIZE,
+    router: Optional[ShardRouter] = None,
+):
+    server = WebhookServer(
+        updater=updater,
+        listen=listen,
+        port=port,
+        secret_token=secret_token,
+        queue_size=queue_size,
+        router=router,
+    )
+
+    # without a public URL the endpoint is still served, which is handy
+    # for replaying recorded updates locally
+    if webhook_url:
+        set_webhook(updater, webhook_url=webhook_url, secret_token=secret_token)
+
+    if router:
+        threading.Thread(target=server.route_updates, daemon=True).start()
+    else:
+        dispatcher_thread = threading.Thread(
+            target=updater.dispatcher.start, daemon=True
+        )
+        dispatcher_thread.start()
+        threading.Thread(target=server.pump_updates, daemon=True).start()
+        updater.job_queue.start()
+
+    def stop(signum, frame):
+        threading.Thread(target=server.stop).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info(f"Webhook is listening on {listen}:{port}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+    if router:
+        return
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    if updater.dispatcher.persistence:
+        updater.dispatcher.persistence.flush()
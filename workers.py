@@ -0,0 +1,124 @@
+import logging
+import queue
+import threading
+import time
+from itertools import count
+from typing import Callable, Hashable
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+
+logger = logging.getLogger(__file__)
+
+ORDERED_WORKERS = 8
+WORKER_QUEUE_SIZE = 50  # tasks waiting per worker before submit blocks
+
+
+class WorkerStats:
+    def __init__(self):
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float):
+        self.processed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class OrderedWorkerPool:
+    # every key is pinned to one worker, so tasks with the same key run one
+    # after another in submission order while different keys run in parallel;
+    # submit blocks while the worker's queue is full, so a slow pool backs
+    # up into whoever feeds it instead of growing without bound
+    def __init__(
+        self,
+        workers: int = ORDERED_WORKERS,
+        name: str = "ordered",
+        queue_size: int = WORKER_QUEUE_SIZE,
+    ):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.stats = [WorkerStats() for _ in range(workers)]
+        self._round_robin = count()
+        self._threads = [
+            threading.Thread(
+                target=self._work, args=(index,), name=f"{name}:{index}", daemon=True
+            )
+            for index in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key: Hashable, function: Callable, *args):
+        if key is None:
+            key = next(self._round_robin)
+        index = hash(key) % len(self.queues)
+        self.queues[index].put((time.monotonic(), function, args))
+
+    def _work(self, index: int):
+        tasks, stats = self.queues[index], self.stats[index]
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+
+            enqueued_at, function, args = task
+            stats.record(time.monotonic() - enqueued_at)
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Ordered worker task failed")
+
+    def get_stats(self) -> list[dict]:
+        return [
+            {
+                "worker": index,
+                "queue_depth": tasks.qsize(),
+                "processed": stats.processed,
+                "average_wait": stats.total_wait / stats.processed
+                if stats.processed
+                else 0.0,
+                "max_wait": stats.max_wait,
+            }
+            for index, (tasks, stats) in enumerate(zip(self.queues, self.stats))
+        ]
+
+    def stop(self):
+        for tasks in self.queues:
+            tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def get_update_key(update: object) -> Hashable:
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class OrderedDispatcher(Dispatcher):
+    # updates of one user are handled in order, so ConversationHandler
+    # sees their state transitions in sequence, other users don't wait
+    def __init__(self, *args, ordered_workers: int = ORDERED_WORKERS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = OrderedWorkerPool(workers=ordered_workers, name="dispatcher")
+        # called with every update once its handlers have finished
+        self.on_processed = None
+
+    def _process_update(self, update: object):
+        try:
+            super().process_update(update)
+        finally:
+            if self.on_processed:
+                self.on_processed(update)
+
+    def process_update(self, update: object):
+        self.pool.submit(get_update_key(update), self._process_update, update)
+
+    def stop(self):
+        super().stop()
+        self.pool.stop()
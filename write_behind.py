@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable
+
+import redis
+import requests
+
+import elastic_api
+import resilience
+
+
+logger = logging.getLogger(__file__)
+
+BATCH_SIZE = 20
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 5  # seconds
+DEDUPLICATION_TTL = 60 * 60  # seconds
+WRITER_TIMEOUT = 5 * 60  # seconds without a heartbeat
+
+
+class CoordinatesWriter:
+    # coordinates entries are analytics nobody waits for: handlers push them
+    # to a Redis list and a background thread writes them to Moltin; every
+    # writer keeps its jobs in flight in its own processing list
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        get_elastic_token: Callable[[], str],
+        coordinates_slug: str = "coordinates",
+        queue_key: str = "write_behind:coordinates",
+        batch_size: int = BATCH_SIZE,
+        writer_id: str = None,
+    ):
+        self.redis = redis_connection
+        self.get_elastic_token = get_elastic_token
+        self.coordinates_slug = coordinates_slug
+        self.queue_key = queue_key
+        self.writer_id = writer_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.writers_key = f"{queue_key}:writers"
+        self.processing_key = self._get_processing_key(self.writer_id)
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def _get_processing_key(self, writer_id: str) -> str:
+        return f"{self.queue_key}:processing:{writer_id}"
+
+    def heartbeat(self):
+        self.redis.zadd(self.writers_key, {self.writer_id: time.time()})
+
+    def requeue_orphaned(self):
+        # jobs left half-done by a writer that stopped heartbeating are put
+        # back, so an entry may be written twice but is never lost
+        gone_writers = self.redis.zrangebyscore(
+            self.writers_key, 0, time.time() - WRITER_TIMEOUT
+        )
+        for writer_id in gone_writers:
+            processing_key = self._get_processing_key(writer_id.decode())
+            while self.redis.rpoplpush(processing_key, self.queue_key):
+                pass
+            self.redis.zrem(self.writers_key, writer_id)
+
+    def enqueue(self, telegram_id: str, longitude: str, latitude: str):
+        entry = json.dumps(
+            {
+                "telegram_id": str(telegram_id),
+                "longitude": str(longitude),
+                "latitude": str(latitude),
+            },
+            sort_keys=True,
+        )
+        # the same user sending the same location twice is written once
+        entry_hash = hashlib.sha1(entry.encode()).hexdigest()
+        if self.redis.set(
+            f"{self.queue_key}:seen:{entry_hash}", 1, nx=True, ex=DEDUPLICATION_TTL
+        ):
+            self.redis.lpush(self.queue_key, json.dumps({"entry": entry, "attempts": 0}))
+
+    def _take_batch(self) -> list[bytes]:
+        first_job = self.redis.brpoplpush(self.queue_key, self.processing_key, timeout=1)
+        if first_job is None:
+            return []
+
+        batch = [first_job]
+        while len(batch) < self.batch_size:
+            job = self.redis.rpoplpush(self.queue_key, self.processing_key)
+            if job is None:
+                break
+            batch.append(job)
+
+        return batch
+
+    def _write(self, raw_job: bytes, elastic_token: str) -> bool:
+        job = json.loads(raw_job)
+        entry = json.loads(job["entry"])
+        try:
+            elastic_api.create_coordinates_entry(
+                credential_token=elastic_token,
+                coordinates_slug=self.coordinates_slug,
+                telegram_id=entry["telegram_id"],
+                longitude=entry["longitude"],
+                latitude=entry["latitude"],
+            )
+        except resilience.ServiceUnavailableError:
+            # Moltin is known to be down, the entry waits for it without
+            # using up its attempts
+            self.redis.rpush(self.queue_key, raw_job)
+            return False
+        except requests.RequestException:
+            job["attempts"] += 1
+            if job["attempts"] >= MAX_ATTEMPTS:
+                logger.exception(f"Dropping coordinates entry {entry}")
+            else:
+                self.redis.lpush(self.queue_key, json.dumps(job))
+            return False
+        finally:
+            self.redis.lrem(self.processing_key, 1, raw_job)
+
+        return True
+
+    def drain(self):
+        elastic_token = self.get_elastic_token()
+        batch = self._take_batch()
+        if not batch:
+            return
+
+        written = []
+        for raw_job in batch:
+            # a slow batch must not look like a dead writer to the others
+            self.heartbeat()
+            written.append(self._write(raw_job, elastic_token))
+        if not all(written):
+            self._stopped.wait(RETRY_DELAY)
+
+    def _run(self):
+        # a restarted container often comes back with the same host and pid,
+        # so jobs its previous run left half-done look like a live writer's
+        while self.redis.rpoplpush(self.processing_key, self.queue_key):
+            pass
+
+        requeued_at = 0.0
+        while not self._stopped.is_set():
+            try:
+                self.heartbeat()
+                if time.monotonic() - requeued_at >= WRITER_TIMEOUT:
+                    self.requeue_orphaned()
+                    requeued_at = time.monotonic()
+                self.drain()
+            except (redis.RedisError, requests.RequestException):
+                logger.exception("Coordinates writer failed")
+                time.sleep(RETRY_DELAY)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()